@@ -0,0 +1,219 @@
+"""Micro benchmarks for the data processing steps around the SUMO runs.
+
+Run with `python benchmarks.py`; synthetic inputs are written to a temporary folder."""
+
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
+import numpy as np
+from flow_template import compile_flow_template, render_route_files
+from random_route import (add_departures, departure_histogram, generate_trip_batch,
+                          trips_from_batch, write_rou_file)
+from simulation_backends import BACKENDS
+from sumo_interface import parse_emission_data, sum_emissions, write_sumo_config
+
+
+VEHICLE_TYPES = ['pkw', 'bus', 'scooter', 'bike']
+
+
+def write_synthetic_emissions(emission_file, num_steps, vehicles_per_step, seed=0):
+    """write a SUMO-like emission file with num_steps * vehicles_per_step vehicle records"""
+
+    rng = random.Random(seed)
+    with open(emission_file, "w", encoding="utf-8") as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<emission-export>\n')
+        for step in range(num_steps):
+            file.write(f'    <timestep time="{step:.2f}">\n')
+            for i in range(vehicles_per_step):
+                vtype = VEHICLE_TYPES[i % len(VEHICLE_TYPES)]
+                file.write(
+                    f'        <vehicle id="{vtype}_{i}" eclass="HBEFA4/default" '
+                    f'CO2="{rng.uniform(0, 5000):.2f}" CO="{rng.uniform(0, 100):.2f}" '
+                    f'HC="{rng.uniform(0, 5):.2f}" NOx="{rng.uniform(0, 10):.2f}" '
+                    f'PMx="{rng.uniform(0, 1):.2f}" fuel="{rng.uniform(0, 2000):.2f}" '
+                    f'electricity="0.00" noise="{rng.uniform(50, 80):.2f}" route="r{i}" '
+                    f'type="{vtype}" waiting="0.00" lane="L{i % 40}_0" '
+                    f'pos="{rng.uniform(0, 200):.2f}" speed="{rng.uniform(0, 14):.2f}" '
+                    f'angle="90.00" x="{rng.uniform(0, 2000):.2f}" y="{rng.uniform(-800, 0):.2f}"/>\n')
+            file.write('    </timestep>\n')
+        file.write('</emission-export>\n')
+    return num_steps * vehicles_per_step
+
+
+def _parse_emission_data_dom(emission_file):
+    """previous ElementTree implementation, kept as the baseline"""
+    root = ET.parse(emission_file).getroot()
+    totals = [0.0] * 6
+    for timestep in root.findall("timestep"):
+        for vehicle in timestep.findall("vehicle"):
+            for i, key in enumerate(("CO2", "CO", "HC", "NOx", "PMx", "fuel")):
+                totals[i] += float(vehicle.get(key, 0))
+    return totals
+
+
+def bench_emission_parser(num_steps=3600, vehicles_per_step=100):
+    """compare the streaming emission parser against a full ElementTree parse"""
+
+    with tempfile.TemporaryDirectory() as folder:
+        emission_file = os.path.join(folder, "emissions_data.xml")
+        records = write_synthetic_emissions(emission_file, num_steps, vehicles_per_step)
+        size_mb = os.path.getsize(emission_file) / 1e6
+
+        start = time.perf_counter()
+        parse_emission_data(emission_file)
+        streaming = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _parse_emission_data_dom(emission_file)
+        dom = time.perf_counter() - start
+
+    print(f"emission parser: {records} records, {size_mb:.1f} MB")
+    print(f"  streaming : {streaming:6.2f} s  {records / streaming:12,.0f} records/s")
+    print(f"  ElementTree: {dom:6.2f} s  {records / dom:12,.0f} records/s")
+
+
+def _write_rou_file_tree(filename, trips):
+    """previous ElementTree route writer, kept as the baseline"""
+    root = ET.Element("routes")
+    for trip in trips:
+        ET.SubElement(root, "trip", id=trip["id"], type=trip["type"],
+                      depart=str(trip["depart"]), to=trip["to"], **{"from": trip["from"]})
+    ET.ElementTree(root).write(filename, encoding="utf-8", xml_declaration=True)
+
+
+def _measure(function, *args):
+    """run function twice and return (wall time in s, peak traced memory in MB)"""
+    start = time.perf_counter()
+    function(*args)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def bench_route_writer(num_trips=500_000):
+    """compare the streaming route writer (plain and gzip) against an ElementTree build"""
+
+    edges = [f"E{i}" for i in range(200)]
+    batch = generate_trip_batch(num_trips, 3600, [0.6, 0.1, 0.2, 0.1], edges, rng=0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        route_file = os.path.join(folder, "trips.rou.xml")
+        results = {
+            "streaming (batch)": _measure(write_rou_file, route_file, batch),
+            "streaming (batch, gzip)": _measure(write_rou_file, route_file + ".gz", batch),
+            "ElementTree (dicts)": _measure(lambda: _write_rou_file_tree(
+                route_file, trips_from_batch(batch))),
+        }
+
+    print(f"route writer: {num_trips} trips")
+    for name, (seconds, peak) in results.items():
+        print(f"  {name:24s}: {seconds:6.2f} s  {num_trips / seconds:12,.0f} trips/s  "
+              f"peak {peak:8.1f} MB")
+
+
+def bench_online_aggregation(num_trips=20_000, duration=3600):
+    """throughput of online emission aggregation fed by the deterministic fake backend"""
+
+    edges = [f"E{i}" for i in range(200)]
+    batch = generate_trip_batch(num_trips, duration, [0.6, 0.1, 0.2, 0.1], edges, rng=0)
+
+    with tempfile.TemporaryDirectory() as folder:
+        config_file = os.path.join(folder, "fake.sumocfg")
+        write_rou_file(os.path.join(folder, "fake.rou.xml"), batch)
+        with open(config_file, "w", encoding="utf-8") as file:
+            file.write("<configuration/>")
+        write_sumo_config(config_file, config_file, route_files="fake.rou.xml")
+
+        start = time.perf_counter()
+        records = sum(1 for _ in BACKENDS["fake"](config_file, seed=0))
+        generate = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, records = sum_emissions(BACKENDS["fake"](config_file, seed=0))
+        total = time.perf_counter() - start
+
+    print(f"online aggregation (fake backend): {records} records")
+    print(f"  backend only      : {records / generate:12,.0f} records/s")
+    print(f"  backend + totals  : {records / total:12,.0f} records/s")
+
+
+def _departure_histogram_lists(trips, duration, num_bins=60):
+    """previous per-type list and np.histogram binning, kept as the baseline"""
+    type_to_departs = {}
+    for trip in trips:
+        type_to_departs.setdefault(trip["type"], []).append(trip["depart"] / duration)
+    bins = np.linspace(0, 1, num_bins + 1)
+    return {vtype: np.histogram(times, bins=bins)[0] for vtype, times in type_to_departs.items()}
+
+
+def bench_departure_histogram(num_trips=1_000_000, duration=3600):
+    """compare bincount departure histograms against per-type lists and np.histogram"""
+
+    edges = [f"E{i}" for i in range(200)]
+    batch = generate_trip_batch(num_trips, duration, [0.6, 0.1, 0.2, 0.1], edges, rng=0)
+    trips = trips_from_batch(batch)
+    results = {
+        "bincount (batch)": _measure(lambda: add_departures(departure_histogram(duration), batch)),
+        "bincount (dicts)": _measure(lambda: add_departures(departure_histogram(duration), trips)),
+        "lists + np.histogram": _measure(_departure_histogram_lists, trips, duration),
+    }
+
+    print(f"departure histogram: {num_trips} trips")
+    for name, (seconds, peak) in results.items():
+        print(f"  {name:24s}: {seconds:6.2f} s  {num_trips / seconds:12,.0f} trips/s  "
+              f"peak {peak:8.1f} MB")
+
+
+def _adjust_vehicle_numbers_tree(input_file, output_file, new_percent):
+    """previous per scenario ElementTree parse and rewrite of the flow file, kept as the baseline"""
+    tree = ET.parse(input_file)
+    flows = tree.getroot().findall("flow")
+    counts = {vtype: 0 for vtype in new_percent}
+    for flow in flows:
+        if flow.get("type") in counts:
+            counts[flow.get("type")] += int(flow.get("number"))
+    total = sum(counts.values())
+    for flow in flows:
+        vtype = flow.get("type")
+        if vtype in counts:
+            ratio = int(flow.get("number")) / counts[vtype] if counts[vtype] > 0 else 1
+            flow.set("number", str(max(1, int(int(new_percent[vtype] / 100 * total) * ratio))))
+    tree.write(output_file, encoding="utf-8", xml_declaration=True)
+
+
+def bench_flow_scenarios(route_file="complex_juntion.rou.xml", num_scenarios=2000):
+    """compare rendering scenario route files from a compiled flow template against
+    parsing and rewriting the flow file for every scenario"""
+
+    vehicle_types = ["pkw", "bus", "bike", "scooter"]
+    percentages = np.random.default_rng(0).dirichlet(np.ones(len(vehicle_types)),
+                                                     num_scenarios) * 100
+
+    with tempfile.TemporaryDirectory() as folder:
+        output_files = [os.path.join(folder, f"scenario_{i}.rou.xml") for i in range(num_scenarios)]
+        results = {
+            "template (batch)": _measure(lambda: render_route_files(
+                compile_flow_template(route_file), vehicle_types, percentages, output_files)),
+            "ElementTree (per file)": _measure(lambda: [
+                _adjust_vehicle_numbers_tree(route_file, output_file, dict(zip(vehicle_types, row)))
+                for output_file, row in zip(output_files, percentages)]),
+        }
+
+    print(f"flow scenarios: {num_scenarios} route files of {route_file}")
+    for name, (seconds, peak) in results.items():
+        print(f"  {name:24s}: {seconds:6.2f} s  {num_scenarios / seconds:12,.0f} files/s  "
+              f"peak {peak:8.1f} MB")
+
+
+if __name__ == "__main__":
+    bench_emission_parser()
+    bench_route_writer()
+    bench_online_aggregation()
+    bench_departure_histogram()
+    bench_flow_scenarios()
@@ -1,34 +1,181 @@
 """Functions for experimental design and sensitivity analysis"""
 
+import itertools
 from SALib.sample import saltelli
+from SALib.sample import sobol as sobol_sample
+from SALib.sample import morris as morris_sample
+from SALib.analyze import sobol
 import numpy as np
+from scipy.stats import qmc
+from sobol_analysis import sobol_indices
+from surrogate import surrogate_sensitivity
+
+
+VEHICLE_TYPES = ['pkw', 'bus', 'scooter', 'bike']
+
+
+def sobol_problem(names=None):
+    """SALib problem with one independent [0, 1] variable per vehicle type"""
+    names = list(VEHICLE_TYPES if names is None else names)
+    return {
+        'num_vars': len(names),
+        'names': names,
+        'bounds': [[0, 1]] * len(names)
+    }
+
+
+def vehicle_counts_from_samples(param_values, total_vehicles):
+    """normalise each design row to proportions and scale to integer counts summing to
+    total_vehicles (largest remainder rounding, will slightly affect the design).
+    Rows that are all zero get equal shares"""
+
+    param_values = np.asarray(param_values, dtype=float)
+    row_sums = param_values.sum(axis=1, keepdims=True)
+    equal_shares = np.full_like(param_values, 1 / param_values.shape[1])
+    proportions = np.divide(param_values, row_sums, out=equal_shares, where=row_sums > 0)
+
+    # Scale to total vehicle counts
+    exact = proportions * total_vehicles
+    vehicle_counts = np.floor(exact).astype(int)
+
+    # Fix rounding to sum to total_vehicles: one more vehicle for the largest remainders,
+    # ties going to the later vehicle type
+    adjustment = total_vehicles - vehicle_counts.sum(axis=1, keepdims=True)
+    order = np.argsort(exact - vehicle_counts, axis=1, kind="stable")  # smallest remainder first
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.arange(order.shape[1])[None, :], axis=1)
+    vehicle_counts += ranks >= order.shape[1] - adjustment
+
+    return vehicle_counts
+
+
+def simplex_lattice(num_vars, degree):
+    """{num_vars, degree} simplex lattice: every mixture whose proportions are multiples of 1/degree"""
+
+    # stars and bars: the positions of num_vars - 1 bars among degree + num_vars - 1 slots
+    bars = np.array(list(itertools.combinations(range(degree + num_vars - 1), num_vars - 1)),
+                    dtype=int).reshape(-1, num_vars - 1)
+    edges = np.hstack([np.full((len(bars), 1), -1), bars,
+                       np.full((len(bars), 1), degree + num_vars - 1)])
+    return (np.diff(edges, axis=1) - 1) / degree
+
+
+# design generators: (problem, n, seed, options) -> design rows in [0, 1] per vehicle type
+DESIGNS = {
+    "saltelli": lambda problem, n, seed, options: saltelli.sample(  # unscrambled, seed unused
+        problem, n, calc_second_order=options.get("calc_second_order", True)),
+    "lhs": lambda problem, n, seed, options: space_filling_design(n, problem['num_vars'], seed),
+    "morris": lambda problem, n, seed, options: morris_sample.sample(
+        problem, n, num_levels=options.get("num_levels", 4), seed=seed),
+    "simplex_lattice": lambda problem, n, seed, options: simplex_lattice(problem['num_vars'], n),
+}
+
+
+def mixture_design(method, vehicle_types=None, n=512, seed=0, **options):
+    """design rows for a mixture of vehicle types (default: VEHICLE_TYPES).
+
+    method is a key of DESIGNS: "saltelli" (n base samples, for sobol.analyze),
+    "lhs" (n Latin hypercube points), "morris" (n trajectories, for morris.analyze) or
+    "simplex_lattice" (every mixture in steps of 1/n). Rows are normalised to
+    proportions by vehicle_counts_from_samples. Returns (SALib problem, design rows)"""
+
+    if method not in DESIGNS:
+        raise ValueError(f"unknown design {method!r}, choose one of {', '.join(DESIGNS)}")
+    problem = sobol_problem(vehicle_types)
+    return problem, DESIGNS[method](problem, n, seed, options)
+
+
+def design_vehicle_counts(total_vehicles, method="saltelli", vehicle_types=None, n=512,  # pylint: disable=too-many-arguments
+                          seed=0, **options):
+    """integer vehicle counts of each row of a mixture design, see mixture_design"""
+    _, param_values = mixture_design(method, vehicle_types, n, seed, **options)
+    return vehicle_counts_from_samples(param_values, total_vehicles)
 
 
 def sobol_sensitivity(total_vehicles):
     """code to generate sobol design for sensitivity analysis using saltelli sampling"""
 
     # Define problem with 4 independent vars
-    problem = {
-        'num_vars': 4,
-        'names': ['pkw', 'bus', 'scooter', 'bike'],
-        'bounds': [[0, 1]] * 4
-    }
+    problem = sobol_problem()
 
     # Generate Sobol samples (512 samples is hard coded but can be changed)
     param_values = saltelli.sample(problem, 512, calc_second_order=True) 
 
-    # Normalize each row to sum to 1
-    proportions = param_values / param_values.sum(axis=1, keepdims=True)
+    return vehicle_counts_from_samples(param_values, total_vehicles)
 
-    # Scale to total vehicle counts
-    vehicle_counts = np.floor(proportions * total_vehicles).astype(int)
 
-    # Fix rounding to sum to total_vehicles (will slightly affect the design)
-    adjustment = total_vehicles - vehicle_counts.sum(axis=1)
-    for i in range(len(vehicle_counts)):
-        if adjustment[i] > 0:
-            fractions = proportions[i] * total_vehicles - vehicle_counts[i]
-            for idx in np.argsort(fractions)[-adjustment[i]:]:
-                vehicle_counts[i, idx] += 1
+def sobol_batches(problem, initial_n=64, max_n=4096, calc_second_order=True, seed=0):
+    """yield nested Saltelli design batches as (new design rows, N), doubling N each time.
 
-    return vehicle_counts
+    The seeded, scrambled Sobol sequence makes the design for N the first rows of the
+    design for 2N, so each batch only adds the rows of the new base samples and all
+    rows together always form a valid design for SALib's sobol.analyze."""
+
+    done = 0
+    n = initial_n
+    while n <= max_n:
+        param_values = sobol_sample.sample(problem, n, calc_second_order=calc_second_order,
+                                           seed=seed)
+        yield param_values[done:], n
+        done = len(param_values)
+        n *= 2
+
+
+def adaptive_sobol_sensitivity(total_vehicles, evaluate, target_ci_width,  # pylint: disable=too-many-arguments
+                               output_column=None, initial_n=64, max_n=4096,
+                               calc_second_order=True, seed=0, vehicle_types=None):
+    """grow a Sobol design in nested batches until the indices have converged.
+
+    evaluate(vehicle_counts, first_index) simulates the rows of a new batch (design
+    indices first_index onwards) and returns their outputs, one value or one row of
+    values (select the analysed one with output_column) per design row. After each batch
+    S1 / ST are estimated with bootstrap confidence intervals and the design stops
+    growing once every interval is at most target_ci_width wide (or N reaches max_n).
+    Returns (vehicle counts, outputs, SALib indices) of the whole design."""
+
+    problem = sobol_problem(vehicle_types)
+    counts, outputs = [], []
+    for param_values, n in sobol_batches(problem, initial_n, max_n, calc_second_order, seed):
+        new_counts = vehicle_counts_from_samples(param_values, total_vehicles)
+        outputs.append(np.asarray(evaluate(new_counts, sum(len(c) for c in counts))))
+        counts.append(new_counts)
+
+        Y = np.concatenate(outputs)
+        Y = Y if output_column is None else Y[:, output_column]
+        if np.isnan(Y).any():  # failed runs or a sweep stopped early: cannot grow further
+            print(f"N = {n}: {np.isnan(Y).sum()} design points without result, stopping")
+            Si = sobol_indices(Y, problem['num_vars'], calc_second_order, seed=seed)
+            break
+        Si = sobol.analyze(problem, Y, calc_second_order=calc_second_order, seed=seed)
+        width = 2 * max(np.nanmax(Si['S1_conf']), np.nanmax(Si['ST_conf']))
+        print(f"N = {n}: {len(Y)} runs, widest S1/ST confidence interval {width:.4f}")
+        if width <= target_ci_width:
+            break
+
+    return np.concatenate(counts), np.concatenate(outputs), Si
+
+
+def space_filling_design(n_samples, num_vars, seed=0):
+    """Latin hypercube of n_samples points in [0, 1]^num_vars, optimised for low discrepancy"""
+    return qmc.LatinHypercube(d=num_vars, optimization="random-cd", seed=seed).random(n_samples)
+
+
+def surrogate_sobol_sensitivity(total_vehicles, evaluate, n_samples=128,  # pylint: disable=too-many-arguments
+                                output_column=None, max_degree=5, seed=0, vehicle_types=None):
+    """Sobol indices from a polynomial chaos surrogate fitted on a small space filling design.
+
+    evaluate(vehicle_counts, first_index) simulates the design rows as in
+    adaptive_sobol_sensitivity. The surrogate's degree is chosen by leave-one-out cross
+    validation (Si["q2"] close to 1 means the surrogate reproduces held out runs well).
+    Returns (design values, vehicle counts, outputs, indices in SALib's S1 / ST format)."""
+
+    problem = sobol_problem(vehicle_types)
+    param_values = space_filling_design(n_samples, problem['num_vars'], seed)
+    vehicle_counts = vehicle_counts_from_samples(param_values, total_vehicles)
+    outputs = np.asarray(evaluate(vehicle_counts, 0))
+
+    Y = outputs if output_column is None else outputs[:, output_column]
+    valid = ~np.isnan(Y)  # failed runs are left out of the fit
+    Si, _ = surrogate_sensitivity(param_values[valid], Y[valid], max_degree, seed=seed)
+    print(f"Surrogate from {valid.sum()} runs: LOO Q² = {Si['q2']:.4f}")
+    return param_values, vehicle_counts, outputs, Si
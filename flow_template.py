@@ -0,0 +1,98 @@
+"""Compiled template of a flow based .rou.xml file for fast scenario generation.
+
+The route file is parsed once and serialised with a placeholder in the number
+attribute of every <flow>, giving a list of literal text pieces and the flows' types
+and original numbers. A scenario's route file is then the pieces joined with its new
+flow numbers, which are computed for a whole batch of vehicle mixes at once."""
+
+import functools
+import os
+import re
+import xml.etree.ElementTree as ET
+import numpy as np
+
+
+_PLACEHOLDER = "@@flow_number_{}@@"
+_PLACEHOLDER_PATTERN = re.compile(r"@@flow_number_(\d+)@@")
+
+
+def compile_flow_template(route_file):
+    """parse a route file into a template: its text pieces around the flow numbers and
+    the type ("flow_type") and number ("flow_number") of every <flow>"""
+
+    tree = ET.parse(route_file)
+    flows = tree.getroot().findall("flow")
+    flow_type = np.array([flow.get("type") for flow in flows], dtype=object)
+    flow_number = np.array([int(flow.get("number")) for flow in flows], dtype=np.int64)
+    for i, flow in enumerate(flows):
+        flow.set("number", _PLACEHOLDER.format(i))
+
+    text = ET.tostring(tree.getroot(), encoding="unicode")
+    pieces = _PLACEHOLDER_PATTERN.split(text)
+    return {
+        "header": "<?xml version='1.0' encoding='utf-8'?>\n",  # as written by ElementTree
+        "pieces": pieces[0::2],
+        "order": np.array(pieces[1::2], dtype=np.int64),  # flow of each gap between pieces
+        "flow_type": flow_type,
+        "flow_number": flow_number,
+    }
+
+
+@functools.lru_cache(maxsize=16)
+def _cached_template(route_file, _size, _mtime):
+    """template of a route file version, compiled once per process"""
+    return compile_flow_template(route_file)
+
+
+def load_flow_template(route_file):
+    """compiled template of route_file, recompiled only when the file changes"""
+    stat = os.stat(route_file)
+    return _cached_template(os.path.abspath(route_file), stat.st_size, stat.st_mtime_ns)
+
+
+def scenario_flow_numbers(template, vehicle_types, percentages):
+    """flow numbers of a batch of scenarios, one row per row of percentages (columns
+    aligned with vehicle_types, in percent of all vehicles of these types).
+
+    Every type gets its share of the total of the template's flows of these types and
+    splits it over its flows in their original proportions (at least 1 vehicle per
+    flow); flows of other types keep their number."""
+
+    percentages = np.atleast_2d(np.asarray(percentages, dtype=float))
+    flow_number = template["flow_number"]
+    type_index = {vtype: i for i, vtype in enumerate(vehicle_types)}
+    flow_column = np.array([type_index.get(vtype, -1) for vtype in template["flow_type"]],
+                           dtype=np.int64)
+    adjusted = flow_column >= 0
+
+    current = np.bincount(flow_column[adjusted], weights=flow_number[adjusted],
+                          minlength=len(vehicle_types))
+    total = current.sum()
+    new_counts = np.floor((percentages / 100) * total)  # (scenarios, types)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratio = np.where(current[flow_column[adjusted]] > 0,
+                         flow_number[adjusted] / current[flow_column[adjusted]], 1)
+    numbers = np.tile(flow_number, (len(percentages), 1))
+    numbers[:, adjusted] = np.maximum(1, np.floor(new_counts[:, flow_column[adjusted]] * ratio))
+    return numbers
+
+
+def render_route_files(template, vehicle_types, percentages, output_files):
+    """write one route file per scenario (row of percentages, see scenario_flow_numbers)"""
+
+    numbers = scenario_flow_numbers(template, vehicle_types, percentages)
+    pieces = template["pieces"]
+    for output_file, row in zip(output_files, numbers[:, template["order"]].astype(str)):
+        parts = [None] * (2 * len(pieces) - 1)
+        parts[0::2] = pieces
+        parts[1::2] = row
+        with open(output_file, "w", encoding="utf-8") as file:
+            file.write(template["header"])
+            file.write("".join(parts))
+
+
+def adjust_vehicle_numbers(input_file, output_file, new_percent):
+    """write input_file with its flow numbers adjusted to a vehicle mix {type: percent}"""
+    render_route_files(load_flow_template(input_file), list(new_percent),
+                       [list(new_percent.values())], [output_file])
@@ -1,13 +1,29 @@
 import xml.etree.ElementTree as ET  # For parsing and editing XML files (like .rou.xml and .sumocfg)
 import os  # For handling file system operations
-import shutil  # For copying files and directories
+import shutil  # For removing temporary scenario workspaces
 import subprocess  # For running external commands (like starting SUMO)
+from concurrent.futures import ProcessPoolExecutor, as_completed  # For running scenarios in parallel
+import numpy as np  # For checking the scenario matrix
 import pandas as pd  # For processing and saving tabular data (CSV)
+import flow_template  # Compiled route file template for fast scenario generation
+from sumo_interface import parse_emission_data  # Streaming emission parser
+import result_cache  # Skip SUMO for scenarios that were already simulated
 
 # Define paths to base input files
 NETWORK_FILE = "simpleT.net.xml"  # The road network file
 ROUTE_FILE = "simpleT.rou.xml"    # The vehicle routes file
 TEMPLATE_CONFIG = "template.sumocfg"  # A base SUMO config file to clone
+CACHE_DIR = "sim_cache"  # Cached emission totals keyed by the simulation inputs
+SCENARIO_FILE = None  # CSV or YAML scenario matrix (one column / key per vehicle type) to run in batch, None to enter scenarios one by one
+WORKERS = os.cpu_count() or 1  # Number of SUMO runs in parallel in batch mode
+WORKSPACE_ROOT = None  # Folder for route, config and emission files in batch mode (e.g. tmpfs "/dev/shm/multi_case"), None to keep them in the output folder
+
+# SUMO emission attribute -> output column name
+EMISSION_COLUMNS = {
+    "CO2": "CO2 (g)", "CO": "CO (g)",
+    "NOx": "NOx (g)", "PMx": "PMx (g)",
+    "fuel": "Fuel (L)"
+}
 
 # Create output directory if not exist
 OUTPUT_FOLDER = "output/"
@@ -24,34 +40,9 @@ def check_input_files(): # Function to check if all input files exist
         return False # Return False to indicate missing files
     return True
 
-# ✅ Count current number of vehicles of each type
-def get_total_vehicles(root, types):
-    total = 0 
-    counts = {v: 0 for v in types} 
-    for flow in root.findall("flow"):  # Loop through all flow elements
-        vtype = flow.get("type") # Get the vehicle type
-        if vtype in counts:
-            num = int(flow.get("number")) # Get the number of vehicles
-            counts[vtype] += num # Add to the count
-            total += num # Add to the total
-    return total, counts
-
 # ✅ Adjust vehicle counts by percentage
-def adjust_vehicle_numbers(input_file, output_file, new_percent): 
-    tree = ET.parse(input_file) 
-    root = tree.getroot() 
-
-    types = new_percent.keys()  # Get all vehicle types
-    total, current_counts = get_total_vehicles(root, types) # Get current vehicle counts
-    new_counts = {v: int((new_percent[v] / 100) * total) for v in types} # Calculate new counts
-
-    for flow in root.findall("flow"): # Loop through all flow elements
-        vtype = flow.get("type") # Get the vehicle type
-        if vtype in new_counts:
-            original = int(flow.get("number")) # Get the original number of vehicles
-            ratio = original / current_counts[vtype] if current_counts[vtype] > 0 else 1 # Calculate ratio
-            flow.set("number", str(max(1, int(new_counts[vtype] * ratio)))) # Set new number of vehicles
-    tree.write(output_file, encoding="utf-8", xml_declaration=True) # Write the updated XML to a new file
+def adjust_vehicle_numbers(input_file, output_file, new_percent):
+    flow_template.adjust_vehicle_numbers(input_file, output_file, new_percent)  # Route file is parsed once, then only new numbers are filled in
 
 # ✅ Create a custom SUMO config for the scenario
 def create_sumo_config(config_file, route_file, emission_file):
@@ -64,7 +55,7 @@ def create_sumo_config(config_file, route_file, emission_file):
     
     # Update network file path
     for elem in root.findall(".//net-file"): # Find all net-file elements
-        elem.set("value", NETWORK_FILE) # Update the network file path
+        elem.set("value", os.path.abspath(NETWORK_FILE)) # Reference the shared network instead of a copy
 
     # Add or update emission output file
     processing = root.find(".//processing") # Find the processing element
@@ -80,38 +71,115 @@ def create_sumo_config(config_file, route_file, emission_file):
 
 # ✅ Run SUMO simulation
 def run_sumo(config_file, cwd):
-    subprocess.run(["sumo", "-c", config_file], cwd=cwd)
+    return subprocess.run(["sumo", "-c", config_file], cwd=cwd).returncode == 0  # True if SUMO succeeded
 
 # ✅ Parse emissions data
 def parse_emissions(emission_path):
     if not os.path.exists(emission_path):
         print(f"⚠️ File not found: {emission_path}")
         return None
-    tree = ET.parse(emission_path)
-    root = tree.getroot()
-    totals = {
-        "CO2 (g)": 0, "CO (g)": 0,
-        "NOx (g)": 0, "PMx (g)": 0,
-        "Fuel (L)": 0
-    }
-    for timestep in root.findall("timestep"):
-        for vehicle in timestep.findall("vehicle"):
-            totals["CO2 (g)"] += float(vehicle.get("CO2", 0))
-            totals["CO (g)"] += float(vehicle.get("CO", 0))
-            totals["NOx (g)"] += float(vehicle.get("NOx", 0))
-            totals["PMx (g)"] += float(vehicle.get("PMx", 0))
-            totals["Fuel (L)"] += float(vehicle.get("fuel", 0))
-    return pd.DataFrame([totals])
+    return parse_emission_data(emission_path, EMISSION_COLUMNS) # Stream and sum emissions
 
 # ✅ Save DataFrame to CSV
 def save_csv(df, path):
     df.to_csv(path, index=False)
 
-# ✅ Main execution function
-def main():
-    if not check_input_files():
-        return
+# ✅ Simulate one scenario whose route file is already in its workspace folder
+def run_scenario(scenario, distribution, workspace):
+    route_file = os.path.join(workspace, "modified.rou.xml")
+    config_file = os.path.join(workspace, "modified.sumocfg")
+    emission_file = os.path.join(workspace, "emissions.xml")
+    create_sumo_config(config_file, os.path.basename(route_file), os.path.basename(emission_file))  # Create SUMO config
+
+    # Reuse the totals of an identical earlier run, otherwise simulate and cache them
+    key = result_cache.cache_key(NETWORK_FILE, route_file, config_file)
+    cached = result_cache.lookup(CACHE_DIR, key)
+    if cached is not None:
+        print(f"♻️ Scenario {scenario}: identical scenario found in cache, skipping SUMO")
+        df = pd.DataFrame([cached["emissions"]])
+    else:
+        if os.path.exists(emission_file):  # Never read the output of an earlier run
+            os.remove(emission_file)
+        if run_sumo(config_file=os.path.basename(config_file), cwd=workspace): # Run SUMO simulation
+            df = parse_emissions(emission_file) # Parse emission results
+        else:
+            print(f"❌ Scenario {scenario}: SUMO failed")
+            df = None
+        if df is not None:
+            result_cache.store(CACHE_DIR, key, {"emissions": df.iloc[0].to_dict()})
+
+    if df is not None:  # If data is available
+        df["Scenario"] = scenario  # Add scenario number
+        for k, v in distribution.items(): # Add vehicle distribution
+            df[k + " %"] = v
+    return df
+
+# ✅ Read a scenario matrix (CSV or YAML) of vehicle percentages
+def read_scenarios(path):
+    if path.endswith((".yaml", ".yml")):
+        import yaml  # pylint: disable=import-outside-toplevel  # Only needed for YAML matrices
+        with open(path, encoding="utf-8") as f:
+            data = yaml.safe_load(f)  # A list of {type: percent} or {"scenarios": [...]}
+        scenarios = pd.DataFrame(data["scenarios"] if isinstance(data, dict) else data)
+    else:
+        scenarios = pd.read_csv(path)  # One row per scenario, one column per vehicle type
+    scenarios = scenarios.drop(columns=["Scenario"], errors="ignore").fillna(0).astype(float)  # Missing types get 0%
+
+    valid = np.isclose(scenarios.sum(axis=1), 100) # Rows must add up to 100%
+    if not valid.all():
+        print(f"❌ Skipping {(~valid).sum()} scenarios whose total is not 100%")
+    scenarios = scenarios[valid]
+    unique = scenarios.round(9).drop_duplicates().index  # Keep the first of identical mixes
+    if len(unique) < len(scenarios):
+        print(f"♻️ Removed {len(scenarios) - len(unique)} duplicate scenarios")
+    return scenarios.loc[unique].reset_index(drop=True)
+
+# ✅ Run one batch scenario in a worker process and save its CSV
+def run_batch_scenario(scenario, distribution, workspace):
+    folder = os.path.join(OUTPUT_FOLDER, f"scenario_{scenario}")
+    csv_file = os.path.join(folder, f"emissions_scenario_{scenario}.csv")
+    if os.path.exists(csv_file):  # Results of an earlier batch, maybe of another mix
+        os.remove(csv_file)
+    try:
+        df = run_scenario(scenario, distribution, workspace)
+    finally:
+        if WORKSPACE_ROOT:  # Temporary workspace: drop route, config and emission files
+            shutil.rmtree(workspace, ignore_errors=True)
+    if df is not None:
+        os.makedirs(folder, exist_ok=True)
+        save_csv(df, csv_file) # Save data to CSV
+    return df
+
+# ✅ Run every scenario of a scenario matrix on a worker pool
+def run_batch(scenario_file):
+    scenarios = read_scenarios(scenario_file)
+    print(f"🟢 Running {len(scenarios)} scenarios from {scenario_file} on {WORKERS} workers")
+
+    # Render all route files at once from the compiled route template
+    workspaces = [os.path.join(WORKSPACE_ROOT or OUTPUT_FOLDER, f"scenario_{i + 1}")
+                  for i in range(len(scenarios))]
+    for workspace in workspaces:
+        os.makedirs(workspace, exist_ok=True)
+    flow_template.render_route_files(flow_template.load_flow_template(ROUTE_FILE), list(scenarios.columns),
+                                     scenarios.to_numpy(), [os.path.join(w, "modified.rou.xml") for w in workspaces])
 
+    all_data = []  # List to store all dataframes
+    with ProcessPoolExecutor(max_workers=WORKERS) as pool:
+        futures = {pool.submit(run_batch_scenario, i + 1, row.to_dict(), workspace): i + 1
+                   for (i, row), workspace in zip(scenarios.iterrows(), workspaces)}
+        for future in as_completed(futures):  # Scenarios finish in any order
+            try:
+                df = future.result()
+            except Exception as error:  # pylint: disable=broad-except  # One failed scenario must not stop the batch
+                print(f"❌ Scenario {futures[future]} failed: {error}")
+                continue
+            if df is not None:
+                print(f"✅ Scenario {df['Scenario'].iloc[0]} done ({len(all_data) + 1} of {len(scenarios)})")
+                all_data.append(df)
+    return sorted(all_data, key=lambda df: df["Scenario"].iloc[0])  # Back in scenario order
+
+# ✅ Ask for scenarios one by one and run them
+def run_interactive():
     scenario = 1    # Scenario counter
     all_data = []  # List to store all dataframes
 
@@ -132,33 +200,27 @@ def main():
         folder = os.path.join(OUTPUT_FOLDER, f"scenario_{scenario}") # Folder path  
         os.makedirs(folder, exist_ok=True)
 
-        # Define file names per scenario
-        route_file = os.path.join(folder, "modified.rou.xml") 
-        config_file = os.path.join(folder, "modified.sumocfg")
-        emission_file = os.path.join(folder, "emissions.xml")
-        csv_file = os.path.join(folder, f"emissions_scenario_{scenario}.csv")
+        # Adjust vehicle distribution and run simulation (the config references the shared network file)
+        adjust_vehicle_numbers(ROUTE_FILE, os.path.join(folder, "modified.rou.xml"), distribution)  # Adjust vehicle numbers
+        df = run_scenario(scenario, distribution, folder)
 
-        # Copy network file to scenario folder 
-        shutil.copy(NETWORK_FILE, os.path.join(folder, NETWORK_FILE))
-
-        # Adjust vehicle distribution, create config, and run simulation
-        adjust_vehicle_numbers(ROUTE_FILE, route_file, distribution)  # Adjust vehicle numbers
-        create_sumo_config(config_file, os.path.basename(route_file), os.path.basename(emission_file))  # Create SUMO config
-        run_sumo(config_file=os.path.basename(config_file), cwd=folder) # Run SUMO simulation
-
-        # Parse and store emission results
-        df = parse_emissions(emission_file) 
+        # Store emission results
         if df is not None:  # If data is available
-            df["Scenario"] = scenario  # Add scenario number
-            for k, v in distribution.items(): # Add vehicle distribution
-                df[k + " %"] = v 
-            save_csv(df, csv_file) # Save data to CSV
+            save_csv(df, os.path.join(folder, f"emissions_scenario_{scenario}.csv")) # Save data to CSV
             all_data.append(df)     # Append to all data list
 
         again = input("\n➕ Add another scenario? (y/n): ")
         if again.lower() != 'y': # If not 'y',
             break # Exit loop
         scenario += 1 # Increment scenario number
+    return all_data
+
+# ✅ Main execution function
+def main():
+    if not check_input_files():
+        return
+
+    all_data = run_batch(SCENARIO_FILE) if SCENARIO_FILE else run_interactive()
 
     # Merge and save all scenarios into one file
     if all_data:
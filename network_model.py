@@ -0,0 +1,355 @@
+"""Compact, array backed model of a SUMO .net.xml file.
+
+The network is parsed once into NumPy arrays (edges, lanes, connections and the vehicle
+classes allowed on each lane) and saved in a binary sidecar file in a cache folder
+(MODEL_CACHE_DIR). Later loads, from any process, read the sidecar in milliseconds as
+long as the network file is unchanged."""
+
+import functools
+import hashlib
+import os
+import xml.parsers.expat
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import breadth_first_order, connected_components
+
+
+# SUMO vehicle classes, bit i of an allow mask is set if SUMO_VCLASSES[i] may use the lane
+SUMO_VCLASSES = [
+    "private", "emergency", "authority", "army", "vip", "pedestrian", "passenger", "hov",
+    "taxi", "bus", "coach", "delivery", "truck", "trailer", "motorcycle", "moped",
+    "bicycle", "evehicle", "tram", "rail_urban", "rail", "rail_electric", "rail_fast",
+    "ship", "container", "cable_car", "subway", "aircraft", "wheelchair", "scooter",
+    "drone", "custom1", "custom2"
+]
+ALL_VCLASSES = (1 << len(SUMO_VCLASSES)) - 1
+SIDECAR_SUFFIX = ".model.npz"
+MODEL_CACHE_DIR = os.environ.get(  # folder of the sidecar files, outside the source tree
+    "NETWORK_MODEL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "network_models"))
+REACHABLE_CACHE_SIZE = 1024  # reachable component sets kept per OD index
+
+
+def vclass_mask(vclasses):
+    """allow mask of a space separated list of vehicle classes ('all' for every class)"""
+    mask = 0
+    for vclass in vclasses.split():
+        if vclass == "all":
+            return ALL_VCLASSES
+        if vclass in SUMO_VCLASSES:
+            mask |= 1 << SUMO_VCLASSES.index(vclass)
+    return mask
+
+
+def _lane_mask(attrs):
+    """allow mask of a <lane> element from its allow / disallow attributes"""
+    if "allow" in attrs:
+        return vclass_mask(attrs["allow"])
+    if "disallow" in attrs:
+        return ALL_VCLASSES & ~vclass_mask(attrs["disallow"])
+    return ALL_VCLASSES
+
+
+def parse_network(net_file):
+    """stream a .net.xml file into the network model, a dict of NumPy arrays.
+
+    edge_* arrays describe the normal (non internal) edges in file order, lane_* arrays
+    their lanes (lane_edge indexes the edge arrays) and conn_* arrays the connections
+    between normal edges (conn_from / conn_to index the edge arrays)."""
+
+    edges = {"id": [], "from": [], "to": []}
+    lanes = {"edge": [], "index": [], "length": [], "speed": [], "allow": []}
+    connections = []
+    current = [None]  # index of the normal edge being read, None inside internal edges
+
+    def start_element(name, attrs):
+        if name == "edge":
+            if attrs.get("function") == "internal" or attrs["id"].startswith(":"):
+                current[0] = None
+            else:
+                current[0] = len(edges["id"])
+                edges["id"].append(attrs["id"])
+                edges["from"].append(attrs.get("from", ""))
+                edges["to"].append(attrs.get("to", ""))
+        elif name == "lane" and current[0] is not None:
+            lanes["edge"].append(current[0])
+            lanes["index"].append(int(attrs.get("index", 0)))
+            lanes["length"].append(float(attrs.get("length", 0)))
+            lanes["speed"].append(float(attrs.get("speed", 0)))
+            lanes["allow"].append(_lane_mask(attrs))
+        elif name == "connection" and not attrs["from"].startswith(":"):
+            connections.append((attrs["from"], attrs["to"], int(attrs.get("fromLane", 0)),
+                                int(attrs.get("toLane", 0))))
+
+    def end_element(name):
+        if name == "edge":
+            current[0] = None
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    with open(net_file, "rb") as file:
+        parser.ParseFile(file)
+
+    lane_edge = np.asarray(lanes["edge"], dtype=np.int32)
+    lane_length = np.asarray(lanes["length"], dtype=np.float64)
+    lane_speed = np.asarray(lanes["speed"], dtype=np.float64)
+    lane_allow = np.asarray(lanes["allow"], dtype=np.uint64)
+    num_edges = len(edges["id"])
+
+    edge_allow = np.zeros(num_edges, dtype=np.uint64)
+    np.bitwise_or.at(edge_allow, lane_edge, lane_allow)
+    edge_length = np.zeros(num_edges)
+    np.maximum.at(edge_length, lane_edge, lane_length)
+    edge_speed = np.zeros(num_edges)
+    np.maximum.at(edge_speed, lane_edge, lane_speed)
+
+    edge_index = {edge_id: i for i, edge_id in enumerate(edges["id"])}
+    connections = [(edge_index[from_edge], edge_index[to_edge], from_lane, to_lane)
+                   for from_edge, to_edge, from_lane, to_lane in connections
+                   if from_edge in edge_index and to_edge in edge_index]
+    connections = np.asarray(connections, dtype=np.int32).reshape(-1, 4)
+
+    return {
+        "edge_id": np.asarray(edges["id"], dtype=str),
+        "edge_from_node": np.asarray(edges["from"], dtype=str),
+        "edge_to_node": np.asarray(edges["to"], dtype=str),
+        "edge_lanes": np.bincount(lane_edge, minlength=num_edges).astype(np.int16),
+        "edge_length": edge_length,
+        "edge_speed": edge_speed,
+        "edge_allow": edge_allow,
+        "lane_edge": lane_edge,
+        "lane_index": np.asarray(lanes["index"], dtype=np.int16),
+        "lane_length": lane_length,
+        "lane_speed": lane_speed,
+        "lane_allow": lane_allow,
+        "conn_from": connections[:, 0],
+        "conn_to": connections[:, 1],
+        "conn_from_lane": connections[:, 2].astype(np.int16),
+        "conn_to_lane": connections[:, 3].astype(np.int16),
+    }
+
+
+def _file_hash(file_name):
+    """sha1 of a file's content"""
+    digest = hashlib.sha1()
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _read_sidecar(sidecar, net_file):
+    """network model stored in sidecar if it still matches net_file, else None"""
+
+    try:
+        with np.load(sidecar) as stored:
+            model = {name: stored[name] for name in stored.files}
+    except (OSError, ValueError):
+        return None
+
+    stat = os.stat(net_file)
+    size, mtime, content_hash = (model.pop(name) for name in
+                                 ("source_size", "source_mtime", "source_hash"))
+    if size == stat.st_size and mtime == stat.st_mtime_ns:
+        return model
+    # touched but maybe not modified (e.g. a fresh checkout): compare the content
+    if str(content_hash) == _file_hash(net_file):
+        _write_sidecar(sidecar, net_file, model)
+        return model
+    return None
+
+
+def _write_sidecar(sidecar, net_file, model):
+    """save the network model in its sidecar, tagged with the network's size, mtime and hash"""
+
+    stat = os.stat(net_file)
+    temporary = f"{sidecar}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(sidecar), exist_ok=True)
+        with open(temporary, "wb") as file:
+            np.savez(file, source_size=stat.st_size, source_mtime=stat.st_mtime_ns,
+                     source_hash=_file_hash(net_file), **model)
+        os.replace(temporary, sidecar)
+    except OSError:  # read only cache folder: the model is simply rebuilt next time
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+
+def sidecar_file(net_file):
+    """sidecar of a network file in MODEL_CACHE_DIR, named after the file and its path"""
+    net_file = os.path.abspath(net_file)
+    path_hash = hashlib.sha1(net_file.encode()).hexdigest()[:16]
+    return os.path.join(MODEL_CACHE_DIR,
+                        f"{os.path.basename(net_file)}.{path_hash}{SIDECAR_SUFFIX}")
+
+
+@functools.lru_cache(maxsize=8)
+def _load_network(net_file, _size, _mtime):
+    """load (or build and save) the network model; cached per file version and process"""
+
+    sidecar = sidecar_file(net_file)
+    model = _read_sidecar(sidecar, net_file) if os.path.exists(sidecar) else None
+    if model is None:
+        model = parse_network(net_file)
+        _write_sidecar(sidecar, net_file, model)
+    for array in model.values():
+        array.flags.writeable = False  # the model is shared by every caller
+    return model
+
+
+def load_network(net_file):
+    """network model of net_file, parsed at most once per file version.
+
+    The model is kept in memory per process and in a sidecar file on disk (see
+    sidecar_file); both are invalidated when the network file changes."""
+
+    net_file = os.path.abspath(net_file)
+    stat = os.stat(net_file)
+    return _load_network(net_file, stat.st_size, stat.st_mtime_ns)
+
+
+def connection_graph(model, vclass=None, weights=None):
+    """sparse edge-to-edge adjacency matrix of the connections usable by vclass
+    (a connection is usable if vclass may use both its from lane and its to lane).
+
+    Entries are 1, or weights[to edge] if a per-edge weight array is given."""
+
+    num_edges = len(model["edge_id"])
+    usable = np.ones(len(model["conn_from"]), dtype=bool)
+    if vclass is not None:
+        bit = np.uint64(vclass_mask(vclass))
+        lane_ids = {(edge, index): i for i, (edge, index) in
+                    enumerate(zip(model["lane_edge"].tolist(), model["lane_index"].tolist()))}
+        for side in ("from", "to"):
+            lanes = [lane_ids.get(key, -1) for key in
+                     zip(model[f"conn_{side}"].tolist(), model[f"conn_{side}_lane"].tolist())]
+            lanes = np.asarray(lanes, dtype=np.int64)
+            usable &= (lanes >= 0) & (model["lane_allow"][lanes] & bit != 0)
+
+    # one entry per pair of edges, however many lane to lane connections join them
+    pairs = np.unique(np.stack([model["conn_from"][usable], model["conn_to"][usable]]), axis=1)
+    data = np.ones(pairs.shape[1]) if weights is None else np.asarray(weights)[pairs[1]]
+    return csr_matrix((data, (pairs[0], pairs[1])), shape=(num_edges, num_edges))
+
+
+def _reachable(index, component):
+    """components reachable from component (itself included) in increasing order, and the
+    cumulative number of allowed edges in them"""
+
+    cached = index["reachable"].get(component)
+    if cached is None:
+        reached = np.sort(breadth_first_order(index["condensation"], component, directed=True,
+                                              return_predecessors=False))
+        cached = reached, np.cumsum(index["size"][reached])
+        if len(index["reachable"]) >= REACHABLE_CACHE_SIZE:
+            index["reachable"].clear()
+        index["reachable"][component] = cached
+    return cached
+
+
+@functools.lru_cache(maxsize=32)
+def _od_index(net_file, _size, _mtime, vclass):
+    """origin / destination index of a network version for one vehicle class"""
+
+    model = load_network(net_file)
+    graph = connection_graph(model, vclass).tocoo()
+    allowed = np.ones(len(model["edge_id"]), dtype=bool) if vclass is None else \
+        model["edge_allow"] & np.uint64(vclass_mask(vclass)) != 0
+
+    # condensation: edges that can reach each other share a strongly connected component
+    num_components, component = connected_components(graph, directed=True, connection="strong")
+    row, col = component[graph.row], component[graph.col]
+    between = row != col
+    condensation = csr_matrix((np.ones(between.sum()), (row[between], col[between])),
+                              shape=(num_components, num_components))
+
+    edges = np.nonzero(allowed)[0]
+    size = np.bincount(component[edges], minlength=num_components)
+    index = {
+        "component": component,
+        "allowed": allowed,
+        "condensation": condensation,
+        "members": edges[np.argsort(component[edges], kind="stable")],  # allowed edges by component
+        "start": np.cumsum(size) - size,
+        "size": size,
+        "reachable": {},
+    }
+
+    # every other allowed edge of the reachable components is a destination
+    reach = np.zeros(num_components, dtype=np.int64)
+    for origin_component in np.unique(component[edges]):
+        reached = breadth_first_order(condensation, origin_component, directed=True,
+                                      return_predecessors=False)
+        reach[origin_component] = size[reached].sum()
+    count = reach[component[edges]] - 1
+    index["origins"] = edges[count > 0]
+    index["pair_end"] = np.cumsum(count[count > 0])
+    index["num_pairs"] = int(index["pair_end"][-1]) if len(index["pair_end"]) else 0
+    for array in index.values():
+        if isinstance(array, np.ndarray):
+            array.flags.writeable = False
+    return index
+
+
+def od_index(net_file, vclass=None):
+    """index of every (origin edge, destination edge) pair between which vclass can be
+    routed: both edges allow vclass and the destination is reachable through connections
+    whose lanes allow vclass.
+
+    The pairs are not stored: the index holds the strongly connected components of the
+    connection graph and their condensation, and index["num_pairs"] pairs are numbered
+    by origin, see od_pairs_at. It is computed once per network version, vehicle class
+    and process."""
+
+    net_file = os.path.abspath(net_file)
+    stat = os.stat(net_file)
+    return _od_index(net_file, stat.st_size, stat.st_mtime_ns, vclass)
+
+
+def od_pairs_valid(index, origins, destinations):
+    """boolean array telling which (origin, destination) edges (indices into the model's
+    edges) are valid pairs of the index, i.e. could be drawn by od_pairs_at"""
+
+    origins = np.asarray(origins, dtype=np.int64)
+    destinations = np.asarray(destinations, dtype=np.int64)
+    component = index["component"]
+    valid = index["allowed"][origins] & index["allowed"][destinations] & (origins != destinations)
+    candidates = np.nonzero(valid)[0]
+    order = candidates[np.argsort(component[origins[candidates]], kind="stable")]
+    groups, group_start = np.unique(component[origins[order]], return_index=True)
+    for origin_component, trips in zip(groups, np.split(order, group_start[1:])):
+        reached, _ = _reachable(index, origin_component)
+        target = component[destinations[trips]]
+        position = np.minimum(np.searchsorted(reached, target), len(reached) - 1)
+        valid[trips] = reached[position] == target
+    return valid
+
+
+def od_pairs_at(index, ranks):
+    """origin and destination edge (indices into the model's edges) of the pairs numbered
+    ranks (integers below index["num_pairs"]), so drawing uniform ranks samples uniform
+    valid trips. Destinations are found on the reachable components of each origin,
+    computed when first needed."""
+
+    ranks = np.asarray(ranks, dtype=np.int64)
+    pair_end = index["pair_end"]
+    position = np.searchsorted(pair_end, ranks, side="right")
+    origins = index["origins"][position]
+    counts = np.diff(pair_end, prepend=0)
+    ranks = ranks - (pair_end[position] - counts[position])  # rank among the origin's pairs
+
+    component, members, start, size = (index[name] for name in
+                                       ("component", "members", "start", "size"))
+    destinations = np.empty_like(origins)
+    order = np.argsort(component[origins], kind="stable")  # trips grouped by origin component
+    groups, group_start = np.unique(component[origins][order], return_index=True)
+    for origin_component, trips in zip(groups, np.split(order, group_start[1:])):
+        reached, cumulative = _reachable(index, origin_component)
+        # skip the origin itself in the allowed edges of the reached components
+        own = members[start[origin_component]:start[origin_component] + size[origin_component]]
+        skipped = (cumulative[np.searchsorted(reached, origin_component)]
+                   - size[origin_component] + np.searchsorted(own, origins[trips]))
+        rank = ranks[trips] + (ranks[trips] >= skipped)
+        j = np.searchsorted(cumulative, rank, side="right")
+        destinations[trips] = members[start[reached[j]] + rank - (cumulative[j] - size[reached[j]])]
+    return origins, destinations
@@ -1,122 +1,385 @@
 """Functions to generate random routes for selected vehicle types and 
 plot departure distributions."""
 
+import gzip
 import random
+from concurrent.futures import ProcessPoolExecutor
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import quoteattr
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
+from experimental_design import vehicle_counts_from_samples
+from network_model import load_network, od_index, od_pairs_at, od_pairs_valid
+from routing import route_trip_batch
+
+
+VEHICLE_TYPES = ['pkw', 'bus', 'scooter', 'bike']   # caution this is hard coded!!
+# SUMO vehicle class of each type, as defined by the vTypes in complex_juntion.rou.xml
+VEHICLE_CLASSES = {'pkw': 'passenger', 'bus': 'bus', 'scooter': 'moped', 'bike': 'bicycle',
+                   'truck': 'truck'}
+# rounds of shared origin / destination candidates drawn with common random numbers
+CRN_OD_CANDIDATES = 64
 
 
 def get_edges_from_net(net_file):
-    """find edges for a given route .net file"""
+    """find edges for a given route .net file (internal junction edges are skipped).
+    The network is parsed once and then served from the cached network model"""
 
-    tree = ET.parse(net_file)
-    root = tree.getroot()
-    edges = []
-    for edge in root.findall("edge"):
-        edge_id = edge.get("id")
-        if not edge_id.startswith(":"):  # skip internal junctions
-            edges.append(edge_id)
-    return edges
+    return load_network(net_file)["edge_id"].tolist()
+
+
+def get_vehicle_types_from_rou(route_file):
+    """vTypes defined in a .rou.xml file as {id: SUMO vehicle class}, in file order"""
+
+    vehicle_types = {}
+    for _, element in ET.iterparse(route_file):
+        if element.tag == "vType":
+            vehicle_types[element.get("id")] = element.get("vClass", "passenger")
+        element.clear()
+    return vehicle_types
+
+
+def write_vtype_file(route_files, output_file):
+    """copy the vTypes defined in route files into an additional file, so generated
+    trips (which carry no vType definitions) can refer to them"""
 
+    with open(output_file, "w", encoding="utf-8") as file:
+        file.write("<?xml version='1.0' encoding='utf-8'?>\n<additional>\n")
+        for route_file in route_files:
+            for _, element in ET.iterparse(route_file):
+                if element.tag == "vType":
+                    element.tail = None
+                    file.write(f"    {ET.tostring(element, encoding='unicode')}\n")
+                    element.clear()
+        file.write("</additional>\n")
 
-def weighted_choice(vehicle_proportions):
+
+def weighted_choice(vehicle_proportions, rng=random, vehicle_types=VEHICLE_TYPES):
     """choose vehicle type based on random weights defined"""
-    items = ['pkw', 'bus', 'scooter', 'bike']   # caution this is hard coded!!
+    items = vehicle_types
     weights = vehicle_proportions/sum(vehicle_proportions)
-    return random.choices(items, weights=weights, k=1)[0]
+    return rng.choices(items, weights=weights, k=1)[0]
+
+
+def generate_trip_batch(num_vehicles, duration, proportions, edges, rng=None,  # pylint: disable=too-many-arguments
+                        vehicle_types=VEHICLE_TYPES, type_od_index=None,
+                        common_random_numbers=False):
+    """draw all trips at once and return them as a columnar trip batch sorted by departure.
+
+    The batch is a dict of NumPy columns: id (draw number), depart, type (index into
+    batch["type_names"]), from and to (indices into batch["edges"], never equal).
+    rng is a np.random.Generator or a seed for one (None draws a fresh seed).
+    If type_od_index is given (one network_model.od_index per vehicle type) each trip is
+    drawn uniformly among the valid pairs of its type, otherwise among all pairs of
+    distinct edges.
 
+    With common_random_numbers every random number is drawn before the vehicle mix is
+    looked at, so batches from the same seed share departure times and origins /
+    destinations and differ only in the vehicle types: exactly the largest remainder
+    counts of proportions, assigned along a fixed random ranking of the vehicles. With
+    type_od_index every vehicle takes the first of a shared series of candidate pairs
+    (uniform over all pairs of distinct edges) that is valid for its type, so a vehicle
+    that changes type keeps its trip whenever the new type can drive it first (most of
+    the time if the types' pairs largely overlap). Vehicles without a valid candidate
+    after CRN_OD_CANDIDATES rounds fall back to a draw among the pairs of their type,
+    which are numbered per type and so differ between types."""
 
-def generate_trips(num_vehicles, duration, proportions, edges):
+    rng = np.random.default_rng(rng)
+    weights = np.asarray(proportions, dtype=float)
+    weights = weights / weights.sum()
+
+    depart = np.round(rng.uniform(0, duration, num_vehicles), 2)
+    if common_random_numbers:
+        rank = rng.permutation(num_vehicles)
+        od_draws = rng.random((2, num_vehicles))
+        type_counts = vehicle_counts_from_samples(weights[None, :], num_vehicles)[0]
+        types = np.searchsorted(np.cumsum(type_counts), rank, side="right")
+    else:
+        types = rng.choice(len(vehicle_types), size=num_vehicles, p=weights)
+
+    if type_od_index is None:
+        if common_random_numbers:
+            from_edges = (od_draws[0] * len(edges)).astype(np.int64)
+            to_edges = (od_draws[1] * (len(edges) - 1)).astype(np.int64)
+        else:
+            from_edges = rng.integers(0, len(edges), num_vehicles)
+            to_edges = rng.integers(0, len(edges) - 1, num_vehicles)
+        to_edges += to_edges >= from_edges  # skip the origin so from != to
+    else:
+        from_edges = np.zeros(num_vehicles, dtype=np.int64)
+        to_edges = np.zeros(num_vehicles, dtype=np.int64)
+        drawn = np.zeros(num_vehicles, dtype=bool)
+        for _ in range(CRN_OD_CANDIDATES if common_random_numbers else 0):
+            candidates = rng.random((2, num_vehicles))  # all vehicles, so the series is shared
+            candidate_from = (candidates[0] * len(edges)).astype(np.int64)
+            candidate_to = (candidates[1] * (len(edges) - 1)).astype(np.int64)
+            candidate_to += candidate_to >= candidate_from
+            for i, index in enumerate(type_od_index):
+                pending = np.nonzero((types == i) & ~drawn)[0]
+                valid = pending[od_pairs_valid(index, candidate_from[pending],
+                                               candidate_to[pending])]
+                from_edges[valid], to_edges[valid] = candidate_from[valid], candidate_to[valid]
+                drawn[valid] = True
+            if drawn.all():
+                break
+        for i, index in enumerate(type_od_index):
+            of_type = (types == i) & ~drawn
+            if not of_type.any():
+                continue
+            if index["num_pairs"] == 0:
+                raise ValueError(f"no routable origin/destination pair for {vehicle_types[i]}")
+            if common_random_numbers:  # no valid candidate: one draw among the type's pairs
+                pairs = (od_draws[0, of_type] * index["num_pairs"]).astype(np.int64)
+            else:
+                pairs = rng.integers(0, index["num_pairs"], of_type.sum())
+            from_edges[of_type], to_edges[of_type] = od_pairs_at(index, pairs)
+
+    order = np.argsort(depart, kind="stable")
+    return {
+        "id": order,
+        "depart": depart[order],
+        "type": types[order],
+        "from": from_edges[order],
+        "to": to_edges[order],
+        "type_names": list(vehicle_types),
+        "edges": list(edges),
+    }
+
+
+def trips_from_batch(batch):
+    """convert a trip batch into the list of trip dicts used by the writers and plots"""
+    type_names = np.asarray(batch["type_names"])[batch["type"]]
+    edges = np.asarray(batch["edges"])
+    return [{"id": f"{veh_type}_{i}", "type": veh_type, "depart": depart,
+             "from": from_edge, "to": to_edge}
+            for i, veh_type, depart, from_edge, to_edge in zip(
+                batch["id"].tolist(), type_names.tolist(), batch["depart"].tolist(),
+                edges[batch["from"]].tolist(), edges[batch["to"]].tolist())]
+
+
+def generate_trips(num_vehicles, duration, proportions, edges, rng=None):
     """generate trips each trip is generated from a randomly chosen vehicle. 
-    The choice of vehicle is based on the proportions defined by vehicle_counts"""
+    The choice of vehicle is based on the proportions defined by vehicle_counts.
+    Trips are drawn in bulk by generate_trip_batch and returned sorted by departure"""
 
-    trips = []
-    for i in range(num_vehicles):
-        depart = round(random.uniform(0, duration), 2)
-        veh_type = weighted_choice(proportions)
-        from_edge, to_edge = random.sample(edges, 2)
-        trips.append({
-            "id": f"{veh_type}_{i}",
-            "type": veh_type,
-            "depart": depart,
-            "from": from_edge,
-            "to": to_edge
-        })
-    return trips
+    return trips_from_batch(generate_trip_batch(num_vehicles, duration, proportions, edges, rng))
 
 
-def write_rou_file(filename, trips):
-    """write trips to a .rou.xml file"""
-    root = ET.Element("routes")
+def _trip_lines(trips, chunk_size):
+    """format trips (an iterable of trip dicts or a trip batch) as <trip> lines, chunk by chunk.
+    Trips of a batch with a route column are written as <vehicle> lines using that route"""
 
-    # Add trips
+    if isinstance(trips, dict):  # columnar trip batch
+        type_names = np.asarray([quoteattr(name) for name in trips["type_names"]])
+        edges = np.asarray([quoteattr(edge) for edge in trips["edges"]])
+        no_routes = np.full(len(trips["depart"]), -1)
+        for start in range(0, len(trips["depart"]), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            types = type_names[trips["type"][chunk]]
+            yield [f'    <vehicle id="{name[1:-1]}_{i}" type={name} depart="{depart}" '
+                   f'route="r{route}"/>\n' if route >= 0 else
+                   f'    <trip id="{name[1:-1]}_{i}" type={name} depart="{depart}" '
+                   f'from={from_edge} to={to_edge}/>\n'
+                   for i, name, depart, from_edge, to_edge, route in zip(
+                       trips["id"][chunk].tolist(), types.tolist(),
+                       trips["depart"][chunk].tolist(),
+                       edges[trips["from"][chunk]].tolist(), edges[trips["to"][chunk]].tolist(),
+                       trips.get("route", no_routes)[chunk].tolist())]
+        return
+
+    lines = []
     for trip in trips:
-        ET.SubElement(root, "trip", id=trip["id"], type=trip["type"],
-                      depart=str(trip["depart"]), from_=trip["from"], to=trip["to"])
+        lines.append(f'    <trip id={quoteattr(trip["id"])} type={quoteattr(trip["type"])} '
+                     f'depart="{trip["depart"]}" from={quoteattr(trip["from"])} '
+                     f'to={quoteattr(trip["to"])}/>\n')
+        if len(lines) == chunk_size:
+            yield lines
+            lines = []
+    yield lines
 
-    # Write to file
-    tree = ET.ElementTree(root)
-    tree.write(filename, encoding="utf-8", xml_declaration=True)
-    print(f"Generated {len(trips)} trips and saved to {filename}")
 
+def write_rou_file(filename, trips, chunk_size=10000):
+    """write trips to a .rou.xml file (gzip compressed if filename ends with .gz).
 
-def plot_departure_histogram_by_type(trips, duration, num_bins=60): # pylint: disable=too-many-locals
-    """plot the distribution of vehicle departures over normalised time by vehicle type"""
+    trips is an iterable of trip dicts or a trip batch from generate_trip_batch (routed
+    batches, see routing.route_trip_batch, are written as vehicles on explicit routes).
+    Trips are written chunk by chunk as they are consumed, so memory does not grow
+    with demand."""
 
-    # Create dict: {type: [depart_times]}
-    type_to_departs = {}
-    for trip in trips:
-        vtype = trip["type"]
-        norm_depart = trip["depart"] / duration
-        type_to_departs.setdefault(vtype, []).append(norm_depart)
+    if filename.endswith(".gz"):
+        file = gzip.open(filename, "wt", encoding="utf-8", compresslevel=1)  # fast, still ~5x smaller
+    else:
+        file = open(filename, "w", encoding="utf-8")  # pylint: disable=consider-using-with
+    count = 0
+    with file:
+        file.write("<?xml version='1.0' encoding='utf-8'?>\n<routes>\n")
+        if isinstance(trips, dict):  # routes shared by the vehicles of a routed batch
+            for i, edges in enumerate(trips.get("routes", [])):
+                file.write(f'    <route id="r{i}" edges={quoteattr(edges)}/>\n')
+        for lines in _trip_lines(trips, chunk_size):
+            file.write("".join(lines))
+            count += len(lines)
+        file.write("</routes>\n")
+    print(f"Generated {count} trips and saved to {filename}")
 
-    # Bin setup
-    bins = np.linspace(0, 1, num_bins + 1)
-    bin_width = bins[1] - bins[0]
-    bin_centers = bins[:-1] + bin_width / 2
 
-    # Pre-fill counts per vehicle type
-    type_histograms = {}
-    for vtype, times in type_to_departs.items():
-        hist, _ = np.histogram(times, bins=bins)
-        type_histograms[vtype] = hist
+DEPARTURE_COLORS = {"pkw": "#1f77b4", "bus": "#ff7f0e", "scooter": "#2ca02c", "bike": "#d62728"}
+DEFAULT_VEHTYPE = "DEFAULT_VEHTYPE"  # type SUMO gives vehicles without a type attribute
 
-    # Sort types for consistent stacking
-    vehicle_types_sorted = sorted(type_histograms.keys())
-    colors = {
-        "pkw": "#1f77b4",
-        "bus": "#ff7f0e",
-        "scooter": "#2ca02c",
-        "bike": "#d62728"
-    }
 
-    # Prepare stacked bar data
-    bottom = np.zeros(len(bin_centers))
-    plt.figure(figsize=(10, 4))
+def departure_histogram(duration, num_bins=60):
+    """empty histogram of departures over normalised time (0-1) by vehicle type.
+
+    The histogram is a dict of plain values and arrays: fill it with add_departures,
+    combine histograms of several files or processes with merge_histograms"""
+    return {"duration": duration, "num_bins": num_bins, "type_names": [],
+            "counts": np.zeros((0, num_bins), dtype=np.int64)}
 
-    for vtype in vehicle_types_sorted:
-        counts = type_histograms[vtype]
-        plt.bar(bin_centers, counts, width=bin_width, bottom=bottom,
-                label=vtype, color=colors.get(vtype, None), edgecolor='black')
+
+def _type_rows(histogram, type_names):
+    """histogram rows of type_names, adding rows for types not seen before"""
+    rows = []
+    for name in type_names:
+        if name not in histogram["type_names"]:
+            histogram["type_names"].append(name)
+        rows.append(histogram["type_names"].index(name))
+    missing = len(histogram["type_names"]) - len(histogram["counts"])
+    if missing:
+        histogram["counts"] = np.vstack([histogram["counts"],
+                                         np.zeros((missing, histogram["num_bins"]), np.int64)])
+    return np.asarray(rows, dtype=np.int64)
+
+
+def add_departures(histogram, trips, chunk_size=100000):
+    """add trips to a departure histogram with one bincount per chunk.
+
+    trips is a trip batch (see generate_trip_batch), a chunk from
+    iter_trip_chunks_from_rou, or an iterable of trip dicts (binned chunk by chunk).
+    Departures outside [0, duration] are not counted. Returns the histogram"""
+
+    if not isinstance(trips, dict):
+        departs, types, type_codes = [], [], {}
+        for trip in trips:
+            departs.append(trip["depart"])
+            vtype = trip.get("type") or DEFAULT_VEHTYPE
+            types.append(type_codes.setdefault(vtype, len(type_codes)))
+            if len(departs) == chunk_size:
+                add_departures(histogram, {"depart": departs, "type": types,
+                                           "type_names": list(type_codes)})
+                departs, types = [], []
+        return add_departures(histogram, {"depart": departs, "type": types,
+                                          "type_names": list(type_codes)})
+
+    num_bins = histogram["num_bins"]
+    rows = _type_rows(histogram, trips["type_names"])
+    position = np.asarray(trips["depart"], dtype=float) / histogram["duration"]
+    inside = (position >= 0) & (position <= 1)
+    bins = np.minimum((position[inside] * num_bins).astype(np.int64), num_bins - 1)
+    cells = rows[np.asarray(trips["type"], dtype=np.int64)[inside]] * num_bins + bins
+    histogram["counts"] += np.bincount(cells, minlength=histogram["counts"].size).reshape(
+        histogram["counts"].shape)
+    return histogram
+
+
+def merge_histograms(histograms):
+    """sum departure histograms with the same duration and bins (types are matched by name)"""
+
+    histograms = list(histograms)
+    merged = departure_histogram(histograms[0]["duration"], histograms[0]["num_bins"])
+    for histogram in histograms:
+        if (histogram["duration"], histogram["num_bins"]) != (merged["duration"],
+                                                             merged["num_bins"]):
+            raise ValueError("departure histograms with different bins cannot be merged")
+        rows = _type_rows(merged, histogram["type_names"])
+        merged["counts"][rows] += histogram["counts"]
+    return merged
+
+
+def _route_file_histogram(args):
+    """process pool task: departure histogram of one route file"""
+    route_file, duration, num_bins = args
+    histogram = departure_histogram(duration, num_bins)
+    for chunk in iter_trip_chunks_from_rou(route_file):
+        add_departures(histogram, chunk)
+    return histogram
+
+
+def departure_histogram_from_files(route_files, duration, num_bins=60, workers=1):
+    """departure histogram of every trip in a set of route files, streamed file by file
+    (in parallel on a process pool with workers > 1)"""
+
+    tasks = [(route_file, duration, num_bins) for route_file in route_files]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            return merge_histograms(pool.map(_route_file_histogram, tasks))
+    return merge_histograms(map(_route_file_histogram, tasks))
+
+
+def render_departure_histogram(histogram, output_file=None):
+    """draw a departure histogram as stacked bars by type; shown on screen, or saved
+    without a display if output_file is given (format from its extension, e.g. .png, .svg)"""
+
+    num_bins = histogram["num_bins"]
+    bin_width = 1 / num_bins
+    bin_centers = (np.arange(num_bins) + 0.5) * bin_width
+
+    if output_file is None:
+        fig = plt.figure(figsize=(10, 4))
+    else:
+        fig = Figure(figsize=(10, 4))  # no pyplot, so no display or GUI backend is needed
+    ax = fig.subplots()
+
+    # Sort types for consistent stacking
+    bottom = np.zeros(num_bins)
+    for vtype in sorted(histogram["type_names"]):
+        counts = histogram["counts"][histogram["type_names"].index(vtype)]
+        ax.bar(bin_centers, counts, width=bin_width, bottom=bottom,
+               label=vtype, color=DEPARTURE_COLORS.get(vtype, None), edgecolor='black')
         bottom += counts
 
-    plt.xlabel("Normalized Simulation Time (0–1)")
-    plt.ylabel("Number of Vehicles")
-    plt.title("Vehicle Departures Over Time (Histogram by Type)")
-    plt.legend(title="Vehicle Type")
-    plt.grid(True, axis='y', linestyle='--', alpha=0.5)
-    plt.tight_layout()
-    plt.show()
+    ax.set_xlabel("Normalized Simulation Time (0–1)")
+    ax.set_ylabel("Number of Vehicles")
+    ax.set_title("Vehicle Departures Over Time (Histogram by Type)")
+    ax.legend(title="Vehicle Type")
+    ax.grid(True, axis='y', linestyle='--', alpha=0.5)
+    fig.tight_layout()
+    if output_file is None:
+        plt.show()
+    else:
+        fig.savefig(output_file)
+        print(f"Saved departure histogram to {output_file}")
+
+
+def plot_departure_histogram_by_type(trips, duration, num_bins=60, output_file=None):
+    """plot the distribution of vehicle departures over normalised time by vehicle type.
+    trips is a trip batch or an iterable of trip dicts, see add_departures"""
+
+    histogram = add_departures(departure_histogram(duration, num_bins), trips)
+    render_departure_histogram(histogram, output_file)
 
 
 # generate route file for vehicle_proportions
-def generate_route_file(net_file, route_file, total_vehicles, duration, vehicle_proportions):
-    """generate random routes for a given vehicle proportions and write to a .rou.xml file"""
+def generate_route_file(net_file, route_file, total_vehicles, duration, vehicle_proportions,  # pylint: disable=too-many-arguments
+                        seed=None, pre_route=False, vehicle_types=VEHICLE_TYPES,
+                        vehicle_classes=VEHICLE_CLASSES, common_random_numbers=False):
+    """generate random routes for a given vehicle proportions and write to a .rou.xml file.
+    If seed is given the routes are reproducible, otherwise a fresh seed is drawn.
+    Origins and destinations are only drawn among pairs the vehicle's class can drive.
+    With pre_route the fastest routes are computed here and written as <vehicle>s with
+    explicit routes, so SUMO does not route the trips itself.
+    vehicle_proportions are aligned with vehicle_types, whose SUMO classes are looked up
+    in vehicle_classes (see get_vehicle_types_from_rou).
+    With common_random_numbers (and a seed) route files of different vehicle mixes share
+    departure times and origins / destinations, see generate_trip_batch"""
 
     edges = get_edges_from_net(net_file)
-    trips = generate_trips(total_vehicles, duration, vehicle_proportions, edges)
-    trips.sort(key=lambda x: x["depart"])
+    type_od_index = [od_index(net_file, vehicle_classes[vtype]) for vtype in vehicle_types]
+    trips = generate_trip_batch(total_vehicles, duration, vehicle_proportions, edges, seed,
+                                vehicle_types=vehicle_types, type_od_index=type_od_index,
+                                common_random_numbers=common_random_numbers)
+    if pre_route:
+        route_trip_batch(net_file, trips, vehicle_classes)
 
     write_rou_file(route_file, trips)
 
@@ -127,13 +390,52 @@ def get_trips_from_rou(route_file):
 
     tree = ET.parse(route_file)
     root = tree.getroot()
+    routes = {route.get("id"): route.get("edges").split() for route in root.findall("route")}
     trips = []
-    for trip in root.findall("trip"):
+    for trip in root:
+        if trip.tag == "vehicle":  # pre-routed: origin and destination from its route
+            route = trip.find("route")
+            edges = routes[trip.get("route")] if route is None else route.get("edges").split()
+            from_edge, to_edge = edges[0], edges[-1]
+        elif trip.tag == "trip":
+            from_edge = trip.get("from", trip.get("from_"))  # older files were written with from_
+            to_edge = trip.get("to")
+        else:
+            continue
         trips.append({
             "id": trip.get("id"),
             "type": trip.get("type"),
             "depart": float(trip.get("depart")),
-            "from": trip.get("from"),
-            "to": trip.get("to")
+            "from": from_edge,
+            "to": to_edge
         })
     return trips
+
+
+def iter_trip_chunks_from_rou(route_file, chunk_size=100000):
+    """stream the departures of the <trip>s and <vehicle>s of a .rou.xml file (optionally
+    gzipped) as chunks with a depart column and a type column indexing chunk["type_names"]
+    (vehicles without a type attribute are of type DEFAULT_VEHTYPE)"""
+
+    opener = gzip.open if route_file.endswith(".gz") else open
+    departs, types, type_codes = [], [], {}
+
+    def chunk():
+        return {"depart": np.asarray(departs, dtype=float),
+                "type": np.asarray(types, dtype=np.int64), "type_names": list(type_codes)}
+
+    with opener(route_file, "rb") as file:
+        root = None
+        for event, element in ET.iterparse(file, events=("start", "end")):
+            if root is None:
+                root = element
+            elif event == "end" and element.tag in ("trip", "vehicle"):
+                departs.append(float(element.get("depart")))
+                vtype = element.get("type") or DEFAULT_VEHTYPE
+                types.append(type_codes.setdefault(vtype, len(type_codes)))
+                root.clear()  # drop the elements read so far, memory stays flat
+                if len(departs) == chunk_size:
+                    yield chunk()
+                    departs, types = [], []
+    if departs:
+        yield chunk()
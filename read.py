@@ -1,25 +1,19 @@
-import xml.etree.ElementTree as ET
-from collections import defaultdict
+from sumo_interface import load_tripinfo, tripinfo_statistics
 
-# Load and parse the tripinfo file
-tree = ET.parse('data.xml')
-root = tree.getroot()
+# Load the tripinfo file (streamed into a typed DataFrame)
+trips = load_tripinfo('data.xml')
 
-# Dictionary: {flow_id: {vehicle_type: count}}
-flow_vehicle_counts = defaultdict(lambda: defaultdict(int))
-
-for trip in root.findall('tripinfo'):
-    full_id = trip.get('id')      # e.g., pkw12.0
-    vtype = trip.get('vType')     # e.g., pkw
-
-    if '.' in full_id:
-        flow_id = full_id.split('.')[0]  # e.g., pkw12
-        flow_vehicle_counts[flow_id][vtype] += 1
+# Vehicles per flow id prefix (e.g. pkw12 for pkw12.0) and type
+flow_trips = trips[trips["flow"] != ""]
+flow_vehicle_counts = flow_trips.groupby(["flow", "vType"], observed=True).size()
 
 # In kết quả
 print("📊 Vehicle counts by flow and type:\n")
-for flow_id, vtype_dict in flow_vehicle_counts.items():
+for flow_id, vtype_counts in flow_vehicle_counts.groupby(level="flow", observed=True):
     print(f"Flow: {flow_id}")
-    for vtype, count in vtype_dict.items():
+    for (_, vtype), count in vtype_counts.items():
         print(f"  - {vtype}: {count}")
     print()
+
+print("📊 Trip statistics by vehicle type:\n")
+print(tripinfo_statistics(trips, by="vType").to_string())
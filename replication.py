@@ -0,0 +1,157 @@
+"""Replicated simulation of design points with online statistics.
+
+Every design point is simulated several times with distinct seeds (see
+sweep.point_seed: with common random numbers replicate r of every point uses seed + r
+and so shares its demand, otherwise every replicate of every point has its own seed).
+Only a running mean and variance per point is kept (Welford's algorithm), and the
+number of replicates can grow per point until its relative standard error is small
+enough."""
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import numpy as np
+from scipy.stats import t as t_distribution
+from sumo_interface import EMISSION_COLUMNS
+from random_route import VEHICLE_TYPES
+from results_store import delete_results, open_results, result_row, write_results
+from sweep import init_worker, run_worker_point, temporary_workspaces
+
+
+def welford_update(stats, row, value):
+    """add one observation (a vector of outputs) to the running statistics of a row"""
+    stats["count"][row] += 1
+    delta = value - stats["mean"][row]
+    stats["mean"][row] += delta / stats["count"][row]
+    stats["m2"][row] += delta * (value - stats["mean"][row])
+
+
+def welford_merge(stats, other):
+    """combine running statistics of the same rows computed separately (e.g. in two sweeps)"""
+
+    count = stats["count"] + other["count"]
+    safe = np.maximum(count, 1)[:, None]
+    delta = other["mean"] - stats["mean"]
+    mean = stats["mean"] + delta * (other["count"][:, None] / safe)
+    m2 = stats["m2"] + other["m2"] + delta ** 2 * (
+        stats["count"][:, None] * other["count"][:, None] / safe)
+    return {"count": count, "mean": mean, "m2": m2}
+
+
+def summarize(stats, confidence=0.95):
+    """mean, sample variance, confidence interval half width and relative standard
+    error per row and output (the mean is NaN where no replicate succeeded, the others
+    where fewer than two did)"""
+
+    count = stats["count"][:, None].astype(float)
+    mean = np.where(count > 0, stats["mean"], np.nan)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        variance = np.where(count > 1, stats["m2"] / (count - 1), np.nan)
+        standard_error = np.sqrt(variance / count)
+        half_width = t_distribution.ppf(0.5 + confidence / 2, count - 1) * standard_error
+        rse = standard_error / np.abs(mean)
+    return {"replicates": stats["count"].copy(), "mean": mean,
+            "variance": variance, "ci": half_width, "rse": rse}
+
+
+def _run_replicate(index, replicate, vehicle_proportions, first_index=0):
+    """run one replicate of row `index` (design index first_index + index) in the
+    current worker"""
+    print(f"Running simulation; {first_index + index} (replicate {replicate})")
+    emissions, info = run_worker_point(first_index + index, vehicle_proportions, replicate)
+    return index, emissions, info["seconds"]
+
+
+def run_replicated_sweep(vehicle_counts, settings, workers=1, replicates=3,  # pylint: disable=too-many-arguments,too-many-locals,too-many-statements
+                         max_replicates=None, target_rse=None, rse_column=None,
+                         confidence=0.95, first_index=0, results_db=None, commit_every=64):
+    """simulate every design point `replicates` times and return its summary statistics
+    (see summarize) in design order.
+
+    With target_rse, further replicates of a point are run (up to max_replicates) until
+    the relative standard error of its mean is at most target_rse, for the output
+    rse_column or for every output if None. settings are as for sweep.iter_sweep; the
+    seed (default 0) is the base of the replicates' seeds. Replicates run on `workers`
+    processes and may finish out of order, the statistics do not depend on the order.
+    If results_db is given, the mean, confidence interval ("<pollutant>_ci") and number
+    of replicates of every finished point are written to it (design index first_index
+    onwards), commit_every points at a time."""
+
+    max_replicates = max(replicates, max_replicates or replicates)
+    if settings.get("seed") is None:  # replicates need distinct, reproducible seeds
+        settings = dict(settings, seed=0)
+    num_points = len(vehicle_counts)
+    stats = {"count": np.zeros(num_points, dtype=int),
+             "mean": np.zeros((num_points, len(EMISSION_COLUMNS))),
+             "m2": np.zeros((num_points, len(EMISSION_COLUMNS)))}
+    submitted = np.full(num_points, replicates)
+    finished = np.zeros(num_points, dtype=int)
+    seconds = np.zeros(num_points)
+    tasks = deque((index, replicate) for replicate in range(replicates)
+                  for index in range(num_points))
+    connection = open_results(results_db) if results_db else None
+    if connection:  # points without a successful replicate must not keep an earlier row
+        delete_results(connection, range(first_index, first_index + num_points))
+    rows = []
+
+    def done(index, point):
+        """store the statistics of a point that needs no more replicates"""
+        if connection is None or point["replicates"][0] == 0:
+            return
+        rows.append(result_row(
+            first_index + index, settings.get("vehicle_types", VEHICLE_TYPES),
+            vehicle_counts[index], point["mean"][0], seed=settings.get("seed"),
+            replicates=int(point["replicates"][0]), seconds=seconds[index],
+            **{f"{name}_ci": float(ci) for name, ci in zip(EMISSION_COLUMNS, point["ci"][0])}))
+        if len(rows) >= commit_every:
+            write_results(connection, rows)
+            rows.clear()
+
+    def finish(index, emissions, run_seconds):
+        """record a replicate and queue another one if the point is not precise enough"""
+        finished[index] += 1
+        seconds[index] += run_seconds
+        if not np.isnan(emissions).any():  # failed runs are retried below
+            welford_update(stats, index, emissions)
+        if finished[index] < submitted[index]:
+            return
+        point = summarize({key: value[index:index + 1] for key, value in stats.items()},
+                          confidence)
+        if submitted[index] >= max_replicates:
+            done(index, point)
+            return
+        if stats["count"][index] >= replicates:
+            rse = point["rse"][0] if rse_column is None else point["rse"][0][rse_column]
+            if target_rse is None or np.all(rse <= target_rse):
+                done(index, point)
+                return
+        tasks.append((index, submitted[index]))
+        submitted[index] += 1
+
+    with temporary_workspaces(settings) as workspace_settings:
+        if workers <= 1:
+            init_worker(workspace_settings)
+            while tasks:
+                index, replicate = tasks.popleft()
+                finish(*_run_replicate(index, replicate, vehicle_counts[index], first_index))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                     initargs=(workspace_settings,)) as pool:
+                running = set()
+                while tasks or running:
+                    while tasks:
+                        index, replicate = tasks.popleft()
+                        running.add(pool.submit(_run_replicate, index, replicate,
+                                                vehicle_counts[index], first_index))
+                    completed, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in completed:
+                        finish(*future.result())
+
+    if connection:
+        write_results(connection, rows)
+        connection.close()
+    summary = summarize(stats, confidence)
+    print(f"Replicated sweep: {summary['replicates'].sum()} successful runs of "
+          f"{num_points} design points ({summary['replicates'].min()} to "
+          f"{summary['replicates'].max()} per point)")
+    return summary
@@ -0,0 +1,142 @@
+"""Content addressed cache of simulation results.
+
+A result is keyed by the hash of the network, route and config files, the additional
+files the config loads (e.g. the vTypes of a sweep workspace), the random seed and the
+SUMO version, so identical inputs are only ever simulated once. The cache is a
+folder with one sub folder per key; the least recently used entries are evicted when
+it grows beyond a size limit."""
+
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from sumo_interface import read_sumo_config_option
+
+
+CACHE_MAX_BYTES = 2 * 1024 ** 3  # default size limit of a cache folder
+RESULT_FILE = "result.json"
+
+
+@functools.lru_cache(maxsize=None)
+def sumo_version():
+    """first line of `sumo --version`, or 'unknown' if SUMO cannot be run"""
+    try:
+        output = subprocess.run(["sumo", "--version"], capture_output=True, text=True,
+                                check=False).stdout
+    except OSError:
+        return "unknown"
+    lines = output.strip().splitlines()
+    return lines[0] if lines else "unknown"
+
+
+def _hash_file(digest, file_name):
+    """feed the content of a file to a hashlib digest"""
+    with open(file_name, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+
+
+def cache_key(net_file, route_file, config_file, seed=None, backend="subprocess"):
+    """hash of the simulation inputs that determine its outputs, including the additional
+    files referenced by the config (which only names them)"""
+
+    config_folder = os.path.dirname(os.path.abspath(config_file))
+    additional_files = [os.path.join(config_folder, path) for path in
+                        read_sumo_config_option(config_file, "additional-files", "").split(",")
+                        if path.strip()]
+    digest = hashlib.sha256()
+    for file_name in (net_file, route_file, config_file, *additional_files):
+        _hash_file(digest, file_name)
+        digest.update(b"\0")
+    digest.update(f"seed={seed}\0backend={backend}\0{sumo_version()}".encode())
+    return digest.hexdigest()
+
+
+def lookup(cache_dir, key):
+    """return the cached result for key (or None on a miss).
+
+    The result is the dict given to store(); its "raw" entry maps the names of any
+    stored raw output files to their path inside the cache."""
+
+    entry = os.path.join(cache_dir, key)
+    try:
+        with open(os.path.join(entry, RESULT_FILE), encoding="utf-8") as file:
+            result = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+    os.utime(entry)  # mark as recently used for eviction
+    result["raw"] = {name: os.path.join(entry, name) for name in result.get("raw", [])}
+    return result
+
+
+def store(cache_dir, key, result, raw_files=(), max_bytes=CACHE_MAX_BYTES):
+    """add a JSON serialisable result (and optionally copies of raw output files) to the cache.
+
+    The entry is written to a temporary folder and renamed into place, so concurrent
+    workers storing the same key never leave a partial entry behind."""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(entry):
+        return
+
+    staging = tempfile.mkdtemp(prefix=".staging_", dir=cache_dir)
+    try:
+        for raw_file in raw_files:
+            shutil.copy(raw_file, staging)
+        with open(os.path.join(staging, RESULT_FILE), "w", encoding="utf-8") as file:
+            json.dump(dict(result, raw=[os.path.basename(name) for name in raw_files]), file)
+        os.rename(staging, entry)
+    except OSError:  # another worker stored the same key first
+        shutil.rmtree(staging, ignore_errors=True)
+
+    evict(cache_dir, max_bytes)
+
+
+def _folder_size(folder):
+    """total size in bytes of the files in a folder"""
+    return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+
+def cache_entries(cache_dir):
+    """list (key, size in bytes, last use time) of the cache entries"""
+
+    entries = []
+    if not os.path.isdir(cache_dir):
+        return entries
+    for entry in os.scandir(cache_dir):
+        if entry.is_dir() and not entry.name.startswith("."):
+            try:
+                entries.append((entry.name, _folder_size(entry.path), entry.stat().st_mtime))
+            except OSError:  # evicted by another worker meanwhile
+                continue
+    return entries
+
+
+def evict(cache_dir, max_bytes=CACHE_MAX_BYTES):
+    """delete the least recently used entries until the cache fits in max_bytes"""
+
+    entries = sorted(cache_entries(cache_dir), key=lambda entry: entry[2])
+    total = sum(size for _, size, _ in entries)
+    for key, size, _ in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(cache_dir, key), ignore_errors=True)
+        total -= size
+
+
+def cache_report(cache_dir, hits, misses):
+    """summary of cache efficiency for a run"""
+
+    entries = cache_entries(cache_dir)
+    lookups = hits + misses
+    rate = 100 * hits / lookups if lookups else 0
+    oldest = min((used for _, _, used in entries), default=time.time())
+    return (f"Result cache {cache_dir}: {hits} hits, {misses} misses ({rate:.1f}% hit rate), "
+            f"{len(entries)} entries, {sum(size for _, size, _ in entries) / 1e6:.1f} MB, "
+            f"oldest entry used {(time.time() - oldest) / 3600:.1f} h ago")
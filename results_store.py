@@ -0,0 +1,98 @@
+"""SQLite store of sensitivity study results, one row per design point.
+
+The database runs in WAL mode so the analysis can read it while a sweep is still
+writing, and several sweeps can write to it (each write waits for the others). Rows
+are keyed by design index and hold the vehicle counts ("count_<type>"), the seed,
+every pollutant total (named as the keys of sumo_interface.EMISSION_COLUMNS), run
+timings and any other value given; columns are added as they first appear."""
+
+import sqlite3
+import time
+import pandas as pd
+from sumo_interface import EMISSION_COLUMNS
+
+
+RESULTS_TABLE = "results"
+BUSY_TIMEOUT = 60  # seconds a writer waits for another one to commit
+
+
+def open_results(db_file):
+    """open (and create if needed) a results database"""
+
+    connection = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT)
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")  # durable at checkpoints, safe with WAL
+    pollutants = "".join(f', "{name}" REAL' for name in EMISSION_COLUMNS)
+    connection.execute(f'CREATE TABLE IF NOT EXISTS {RESULTS_TABLE} '
+                       f'(design_index INTEGER PRIMARY KEY, seed INTEGER{pollutants}, '
+                       f'seconds REAL, finished_at REAL)')
+    return connection
+
+
+def _columns(connection):
+    """column names of the results table"""
+    return {row[1] for row in connection.execute(f"PRAGMA table_info({RESULTS_TABLE})")}
+
+
+def result_row(index, vehicle_types, counts, emissions, **values):
+    """results of one design point as a row for write_results"""
+
+    row = {"design_index": int(index), "finished_at": time.time()}
+    row.update({f"count_{vtype}": int(count) for vtype, count in zip(vehicle_types, counts)})
+    row.update({name: float(value) for name, value in zip(EMISSION_COLUMNS, emissions)})
+    row.update(values)
+    return row
+
+
+def write_results(connection, rows, replace=True):
+    """insert rows (dicts with a design_index) in one transaction.
+
+    A row replaces any earlier row of its design point, or with replace=False only
+    updates the columns it has, so values can be added to existing rows later (e.g. the
+    design values of a surrogate study)."""
+
+    if not rows:
+        return
+    with connection:  # one commit for the whole batch
+        existing = _columns(connection)
+        for name in dict.fromkeys(name for row in rows for name in row):  # in row order
+            if name not in existing:
+                connection.execute(f'ALTER TABLE {RESULTS_TABLE} ADD COLUMN "{name}"')
+                existing.add(name)
+        for names in {tuple(row) for row in rows}:  # rows with the same columns together
+            quoted = ", ".join(f'"{name}"' for name in names)
+            updates = ", ".join(f'"{name}" = excluded."{name}"' for name in names
+                                if name != "design_index")
+            conflict = "" if replace else f" ON CONFLICT(design_index) DO UPDATE SET {updates}"
+            connection.executemany(
+                f'INSERT {"OR REPLACE " if replace else ""}INTO {RESULTS_TABLE} ({quoted}) '
+                f'VALUES ({", ".join("?" * len(names))}){conflict}',
+                [tuple(row[name] for name in names) for row in rows if tuple(row) == names])
+
+
+def delete_results(connection, indices):
+    """drop the rows of design points, e.g. before they are simulated again, so a point
+    that now fails or is skipped cannot keep the row of an earlier run"""
+    with connection:
+        connection.executemany(f"DELETE FROM {RESULTS_TABLE} WHERE design_index = ?",
+                               [(int(index),) for index in indices])
+
+
+def trim_results(connection, num_rows):
+    """drop the rows of design points beyond a design of num_rows points"""
+    with connection:
+        connection.execute(f"DELETE FROM {RESULTS_TABLE} WHERE design_index >= ?", (num_rows,))
+
+
+def read_results(db_file, columns=None):
+    """results as a DataFrame indexed by design index in design order
+    (all columns, or the given ones)"""
+
+    connection = sqlite3.connect(db_file, timeout=BUSY_TIMEOUT)
+    try:
+        selected = "*" if columns is None else ", ".join(
+            f'"{name}"' for name in ["design_index", *columns])
+        return pd.read_sql(f"SELECT {selected} FROM {RESULTS_TABLE} ORDER BY design_index",
+                           connection, index_col="design_index")
+    finally:
+        connection.close()
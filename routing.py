@@ -0,0 +1,73 @@
+"""Shortest path routing over the network model, so route files can carry explicit
+routes and SUMO does not have to compute them at insertion time.
+
+Routes minimise free flow travel time (edge length / speed limit) through connections
+usable by the vehicle class, like SUMO's default router on an empty network. One
+shortest path tree is computed per origin edge and vehicle class and cached per process."""
+
+import functools
+import os
+import numpy as np
+from scipy.sparse.csgraph import dijkstra
+from network_model import load_network, connection_graph
+
+
+@functools.lru_cache(maxsize=32)
+def _travel_time_graph(net_file, _size, _mtime, vclass):
+    """connection graph weighted by the free flow travel time of the edge entered"""
+    model = load_network(net_file)
+    travel_time = np.maximum(model["edge_length"] / np.maximum(model["edge_speed"], 0.1), 1e-3)
+    return connection_graph(model, vclass, weights=travel_time)
+
+
+@functools.lru_cache(maxsize=4096)
+def _shortest_path_tree(net_file, size, mtime, vclass, origin):
+    """predecessor array of the shortest path tree rooted at an origin edge"""
+    graph = _travel_time_graph(net_file, size, mtime, vclass)
+    _, predecessors = dijkstra(graph, directed=True, indices=origin, return_predecessors=True)
+    predecessors.flags.writeable = False
+    return predecessors
+
+
+def shortest_path_tree(net_file, origin, vclass=None):
+    """predecessor of every edge on the fastest paths from edge index origin (-9999 if unreachable)"""
+    net_file = os.path.abspath(net_file)
+    stat = os.stat(net_file)
+    return _shortest_path_tree(net_file, stat.st_size, stat.st_mtime_ns, vclass, int(origin))
+
+
+def route_edges(net_file, origin, destination, vclass=None):
+    """edge indices of the fastest route from origin to destination, or None if unreachable"""
+
+    predecessors = shortest_path_tree(net_file, origin, vclass)
+    route = [int(destination)]
+    while route[-1] != origin:
+        previous = predecessors[route[-1]]
+        if previous < 0:
+            return None
+        route.append(int(previous))
+    return route[::-1]
+
+
+def route_trip_batch(net_file, batch, vehicle_classes):
+    """add explicit routes to a trip batch (see random_route.generate_trip_batch).
+
+    vehicle_classes maps the batch's type names to SUMO vehicle classes. Adds the
+    columns "route" (index into batch["routes"], -1 if the trip cannot be routed) and
+    "routes" (space separated edge ids of each distinct route). Each distinct
+    (type, origin, destination) is routed once, from a cached shortest path tree."""
+
+    edge_ids = load_network(net_file)["edge_id"]
+    keys = np.stack([batch["type"], batch["from"], batch["to"]], axis=1)
+    unique_keys, trip_route = np.unique(keys, axis=0, return_inverse=True)
+
+    routes, codes = {}, np.full(len(unique_keys), -1, dtype=np.int64)
+    for i, (vtype, origin, destination) in enumerate(unique_keys.tolist()):
+        vclass = vehicle_classes.get(batch["type_names"][vtype])
+        route = route_edges(net_file, origin, destination, vclass)
+        if route is not None:
+            codes[i] = routes.setdefault(" ".join(edge_ids[route].tolist()), len(routes))
+
+    batch["route"] = codes[trip_route.ravel()]
+    batch["routes"] = list(routes)
+    return batch
@@ -1,48 +1,125 @@
 """sensitivity study to determine sensitivity of inputs and their interactions to PM2.5 using 
 sobol sensitivity analysis"""
 
-import csv
+import os
 import numpy as np
-from experimental_design import sobol_sensitivity
-from random_route import generate_route_file
-from sumo_interface import run_sumo_simulation, parse_emission_data
+from experimental_design import (design_vehicle_counts, adaptive_sobol_sensitivity,
+                                 sobol_problem, surrogate_sobol_sensitivity)
+from random_route import get_vehicle_types_from_rou
+from replication import run_replicated_sweep
+from results_store import open_results, trim_results, write_results
+from sobol_analysis import live_sobol_monitor
+from sweep import run_sweep
 
 
 TOTAL_VEHICLES = 1000
 CONFIG_FILE = "complex_juntion.sumocfg"
 NET_FILE = "complex_juntion.net.xml"
-ROUTE_FILE = "./simpleT_random.rou.xml"
+VTYPE_FILE = "complex_juntion.rou.xml"  # route file defining the vTypes
+VEHICLE_TYPES = ['pkw', 'bus', 'scooter', 'bike']  # vTypes of VTYPE_FILE in the design, None for all
 SIMULATION_DURATION = 500
-RESULTS_FILE = "./sensitivity_results.csv"
-EMISSION_FILE = "emissions_data.xml"
+RESULTS_DB = "./sensitivity_results.sqlite"  # one row per design point, read by sensitivity_study_analysis.py
+MANIFEST_FILE = "./sensitivity_manifest.jsonl"  # completed design points, used to resume a sweep
+WORKSPACE_ROOT = "./sweep_workspaces"  # one sub folder (route, config, emissions) per worker
+WORKERS = os.cpu_count() or 1  # number of SUMO runs in parallel
+SEED = 42  # base of the per point route and SUMO seeds (shared by all points with common random numbers), reruns then hit the cache
+CACHE_DIR = "./sim_cache"  # results of previous simulations, keyed by their inputs
+COMMON_RANDOM_NUMBERS = False  # True: same departures and origins / destinations at every design point
+PRE_ROUTE = False  # True: write vehicles with explicit routes so SUMO does not route every trip
+BACKEND = "subprocess"  # "tail" parses emissions while SUMO runs, "libsumo" sums them in process
+ADAPTIVE = False  # True: grow the (scrambled) design (N = 64, 128, ...) until the indices have converged
+TARGET_CI_WIDTH = 0.1  # widest accepted S1/ST confidence interval in adaptive mode
+MAX_N = 512  # largest Sobol base sample of the adaptive design
+PMX_COLUMN = 4  # position of Total PMx in the emission totals
+DESIGN = "saltelli"  # design when not adaptive: saltelli, lhs, morris or simplex_lattice
+DESIGN_N = 512  # base samples / points / trajectories / lattice degree of DESIGN
+SURROGATE = False  # fit a polynomial surrogate on a small design instead of a Saltelli design
+SURROGATE_SAMPLES = 128  # runs of the space filling design the surrogate is fitted on
+SURROGATE_MANIFEST_FILE = "./surrogate_manifest.jsonl"
+REPLICATES = 1  # SUMO runs per design point (distinct seeds, see sweep.point_seed), >1 analyses their mean
+MAX_REPLICATES = 10  # replicates are added until the PMx mean reaches TARGET_RSE ...
+TARGET_RSE = None  # ... relative standard error (e.g. 0.02), None for exactly REPLICATES
+LIVE_STATUS_FILE = "./sobol_status.json"  # PMx indices of the Saltelli blocks finished so far
+STOP_WHEN_STABLE = False  # stop the sweep once the ranking of the vehicle types is stable
 
-# generate the vehicle proportions for the sensitivity study
-vehicle_counts = sobol_sensitivity(total_vehicles=TOTAL_VEHICLES)
 
-# simulation loop
-for index, vehicle_proportions in enumerate(vehicle_counts): # loop through each set of vehicle proportions   
+def main():
+    """run every design point of the sobol design and write the results in design order"""
 
-    # generate and write output_file for random routes according to the design
-    generate_route_file(
-        net_file=NET_FILE,
-        route_file=ROUTE_FILE,
-        total_vehicles=TOTAL_VEHICLES,
-        duration=SIMULATION_DURATION,
-        vehicle_proportions=vehicle_proportions)
+    vehicle_classes = get_vehicle_types_from_rou(VTYPE_FILE)
+    vehicle_types = list(vehicle_classes) if VEHICLE_TYPES is None else VEHICLE_TYPES
 
-    # run simulation
-    print("Running simulation; ", index)
-    run_sumo_simulation(config_file=CONFIG_FILE) # run simulation
+    settings = {
+        "net_file": NET_FILE,
+        "config_file": CONFIG_FILE,
+        "vtype_file": VTYPE_FILE,
+        "total_vehicles": TOTAL_VEHICLES,
+        "duration": SIMULATION_DURATION,
+        "workspace_root": WORKSPACE_ROOT,
+        "seed": SEED,
+        "pre_route": PRE_ROUTE,
+        "common_random_numbers": COMMON_RANDOM_NUMBERS,
+        "backend": BACKEND,
+        "cache_dir": CACHE_DIR,
+        "vehicle_types": vehicle_types,
+        "vehicle_classes": vehicle_classes,
+    }
 
-    # parse emissions
-    emissions = parse_emission_data(emission_file=EMISSION_FILE) 
+    # live indices while a Saltelli design runs (not for the surrogate or replicated runs)
+    monitor = None
+    if not SURROGATE and REPLICATES <= 1 and (ADAPTIVE or DESIGN == "saltelli"):
+        monitor = live_sobol_monitor(sobol_problem(vehicle_types), LIVE_STATUS_FILE,
+                                     output_column=PMX_COLUMN,
+                                     stop_when_stable=STOP_WHEN_STABLE, seed=SEED)
 
-    # save results
-    # header = ['pkw', 'bus', 'scooter', 'bike', 'Total CO2 (mg)', 
-    # 'Total CO mg)', 'Total HC (mg)', 'Total NOx (mg)', 'Total PMx (mg)', 'Total Fuel (mg)']
-    combined = np.concatenate((vehicle_proportions, + emissions.values[0])) # combine vehicle proportions and emissions
+    def simulate(vehicle_counts, manifest_file, first_index=0):
+        """emission totals of design points, the mean over replicates if REPLICATES > 1
+        (replicated points are not recorded in the manifest, the result cache resumes them)"""
+        if REPLICATES > 1:
+            return run_replicated_sweep(vehicle_counts, settings, workers=WORKERS,
+                                        replicates=REPLICATES, max_replicates=MAX_REPLICATES,
+                                        target_rse=TARGET_RSE, rse_column=PMX_COLUMN,
+                                        first_index=first_index, results_db=RESULTS_DB)["mean"]
+        return run_sweep(vehicle_counts, settings, workers=WORKERS, manifest_file=manifest_file,
+                         first_index=first_index, results_db=RESULTS_DB, on_result=monitor)
 
+    design_values = None
+    if SURROGATE:
+        # a few runs on a space filling design, the indices come from the fitted surrogate
+        design_values, vehicle_counts, emissions, _ = surrogate_sobol_sensitivity(
+            TOTAL_VEHICLES,
+            lambda counts, first_index: simulate(counts, SURROGATE_MANIFEST_FILE, first_index),
+            SURROGATE_SAMPLES, output_column=PMX_COLUMN, seed=SEED, vehicle_types=vehicle_types)
+    elif ADAPTIVE:
+        # simulate batches of design points until the PM2.5 indices have converged
+        vehicle_counts, emissions, _ = adaptive_sobol_sensitivity(
+            TOTAL_VEHICLES,
+            lambda counts, first_index: simulate(counts, MANIFEST_FILE, first_index),
+            TARGET_CI_WIDTH, output_column=PMX_COLUMN, max_n=MAX_N, seed=SEED,
+            vehicle_types=vehicle_types)
+    else:
+        # generate the vehicle proportions for the sensitivity study
+        vehicle_counts = design_vehicle_counts(TOTAL_VEHICLES, DESIGN, vehicle_types, DESIGN_N,
+                                               seed=SEED)
 
-    with open(RESULTS_FILE, mode='a', encoding="utf-8") as file: # write to csv file
-        writer = csv.writer(file)
-        writer.writerow(combined)
+        # simulation loop (design points run on WORKERS processes, finished points are skipped)
+        emissions = simulate(vehicle_counts, MANIFEST_FILE)
+
+    # the sweep has written every successful design point to RESULTS_DB as it finished,
+    # drop rows left over from a larger design run earlier
+    connection = open_results(RESULTS_DB)
+    trim_results(connection, len(vehicle_counts))
+    if design_values is not None:
+        # the surrogate is fitted on the unrounded design values, stored as x_<type>
+        # (only for the points that have a row, failed points must not get one)
+        write_results(connection, [
+            {"design_index": index, **{f"x_{vtype}": float(value)
+                                       for vtype, value in zip(vehicle_types, row)}}
+            for index, row in enumerate(design_values)
+            if not np.isnan(emissions[index]).any()], replace=False)
+    connection.close()
+    print(f"Saved {int((~np.isnan(emissions).any(axis=1)).sum())} of {len(emissions)} "
+          f"design points to {RESULTS_DB}")
+
+if __name__ == "__main__":
+    main()
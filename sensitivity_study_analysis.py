@@ -1,6 +1,10 @@
 """Script to coordinate sensitivity study analysis and visualisation"""
 
-from SALib.analyze import sobol
+import os
+from results_store import read_results
+from sobol_analysis import analyze_outputs
+from sumo_interface import EMISSION_COLUMNS
+from surrogate import surrogate_sensitivity
 import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.stats import spearmanr
@@ -8,83 +12,109 @@ import pandas as pd
 import numpy as np
 
 
-# set results file
-RESULTS_FILE = "./sensitivity_results.csv"
-
-
-# Define problem with 4 independent vars
-problem = {
-    'num_vars': 4,
-    'names': ['pkw', 'bus', 'scooter', 'bike'],
-    'bounds': [[0, 1]] * 4
-}
-
-
-# read in the csv file output from simulations
-data = np.genfromtxt(RESULTS_FILE, delimiter=',', skip_header=0)
-
-
-X = data[:, 0:3]  # input variables
-Y = data[:, 8]  # output variable   
-
-
-# convert Y to np array
-Y = np.array(Y)
-
-
-# Run sobol sensitivity analysis
-Si = sobol.analyze(problem, Y, calc_second_order=True, print_to_console=True)
-
-
-# Visualise results (main effects)
-labels = ['pkw', 'bus', 'scooter', 'bike']
-S1 = Si['S1']
-ST = Si['ST']
-
-x = np.arange(len(labels))
-width = 0.35
-
-plt.bar(x - width/2, S1, width, label='Main Effect')
-plt.bar(x + width/2, ST, width, label='Total Effect')
-plt.xticks(x, labels)
-plt.ylabel('Sensitivity Index')
-plt.title('Sobol Sensitivity Analysis (PM2.5)')
-plt.legend()
-plt.tight_layout()
-plt.show()
-
-
-# Plot scatter plots of each vehicle type vs PM2.5
-
-df = pd.DataFrame(data[:, 0:4], columns=labels) # vehicle proportions
-df['PM2.5'] = data[:, 8]  # PM2.5
-
-# Set up 2x2 grid of plots
-fig, axes = plt.subplots(2, 2, figsize=(12, 8))
-axes = axes.flatten()
-
-for i, var in enumerate(labels):
-    x = df[var]
-    y = df['PM2.5']
-
-    # Plot scatter and regression line
-    sns.regplot(x=x, y=y, ax=axes[i],
-                scatter_kws={'alpha': 0.4},
-                line_kws={'color': 'red'})
-
-    # Spearman correlation
-    rho, pval = spearmanr(x, y)
-
-    # Gradient (slope) of the linear fit
-    slope, intercept = np.polyfit(x, y, deg=1)
-
-    # Title with correlation and gradient
-    axes[i].set_title(
-        f'{var} vs PM2.5\n'
-        f'Spearman r = {rho:.3f}, p = {pval:.3g}, slope = {slope:.3f}'
-    )
-    axes[i].set_xlabel(f'{var} proportion')
-    axes[i].set_ylabel('PM2.5')
-
-plt.tight_layout()
-plt.show()
+# set results database (written by sensitivity_study.py)
+RESULTS_DB = "./sensitivity_results.sqlite"
+OUTPUT = "PMx"  # analysed pollutant, a key of sumo_interface.EMISSION_COLUMNS
+SURROGATE = False  # results come from the surrogate design (sensitivity_study.SURROGATE)
+INDICES_FILE = "./sensitivity_indices.csv"  # S1 / ST / S2 with confidence intervals of every pollutant
+NUM_RESAMPLES = 1000  # bootstrap resamples of the confidence intervals
+WORKERS = os.cpu_count() or 1  # pollutants analysed in parallel
+
+
+def main():  # pylint: disable=too-many-locals
+    """analyse the results of every pollutant and plot the indices and scatter plots of OUTPUT"""
+
+    # read in the results of the simulations, columns by name
+    results = read_results(RESULTS_DB)
+    count_columns = [name for name in results.columns  # types of the current design, in design order
+                     if name.startswith("count_") and results[name].notna().any()]
+    labels = [name[len("count_"):] for name in count_columns]
+
+    # Define problem with one independent var per vehicle type
+    problem = {
+        'num_vars': len(labels),
+        'names': labels,
+        'bounds': [[0, 1]] * len(labels)
+    }
+
+    if not SURROGATE:
+        # keep the Saltelli layout: points that failed or were not simulated are NaN
+        step = 2 * len(labels) + 2
+        results = results.reindex(np.arange(-(-(results.index.max() + 1) // step) * step))
+
+    X = results[count_columns].to_numpy()  # input variables
+    Y = results[OUTPUT].to_numpy()  # output variable
+
+    # Run sobol sensitivity analysis
+    if SURROGATE:
+        # indices of a polynomial surrogate fitted on the unrounded design values (x_<type>)
+        # of the successful runs
+        design = results[[f"x_{name}" for name in labels]].to_numpy()
+        valid = ~np.isnan(design).any(axis=1) & ~np.isnan(Y)
+        Si, _ = surrogate_sensitivity(design[valid], Y[valid])
+        print(f"Surrogate LOO Q² = {Si['q2']:.4f}")
+        print(pd.DataFrame({k: Si[k] for k in ('S1', 'S1_conf', 'ST', 'ST_conf')},
+                           index=problem['names']))
+    else:
+        # indices of every pollutant at once, in one tidy table
+        table, Si_by_output = analyze_outputs(problem, results[list(EMISSION_COLUMNS)],
+                                              num_resamples=NUM_RESAMPLES, workers=WORKERS)
+        table.to_csv(INDICES_FILE, index=False)
+        print(table.to_string(index=False))
+        Si = Si_by_output[OUTPUT]
+
+    # Visualise results (main effects)
+    S1 = Si['S1']
+    ST = Si['ST']
+
+    x = np.arange(len(labels))
+    width = 0.35
+
+    plt.bar(x - width/2, S1, width, label='Main Effect')
+    plt.bar(x + width/2, ST, width, label='Total Effect')
+    plt.xticks(x, labels)
+    plt.ylabel('Sensitivity Index')
+    plt.title('Sobol Sensitivity Analysis (PM2.5)')
+    plt.legend()
+    plt.tight_layout()
+    plt.show()
+
+    # Plot scatter plots of each vehicle type vs PM2.5
+
+    df = pd.DataFrame(X, columns=labels) # vehicle proportions
+    df['PM2.5'] = Y  # PM2.5
+    df = df.dropna()  # design points that failed or were not simulated
+
+    # Set up grid of plots, two per row
+    fig, axes = plt.subplots((len(labels) + 1) // 2, 2, figsize=(12, 4 * ((len(labels) + 1) // 2)))
+    axes = axes.flatten()
+
+    for i, var in enumerate(labels):
+        x = df[var]
+        y = df['PM2.5']
+
+        # Plot scatter and regression line
+        sns.regplot(x=x, y=y, ax=axes[i],
+                    scatter_kws={'alpha': 0.4},
+                    line_kws={'color': 'red'})
+
+        # Spearman correlation
+        rho, pval = spearmanr(x, y)
+
+        # Gradient (slope) of the linear fit
+        slope, intercept = np.polyfit(x, y, deg=1)
+
+        # Title with correlation and gradient
+        axes[i].set_title(
+            f'{var} vs PM2.5\n'
+            f'Spearman r = {rho:.3f}, p = {pval:.3g}, slope = {slope:.3f}'
+        )
+        axes[i].set_xlabel(f'{var} proportion')
+        axes[i].set_ylabel('PM2.5')
+
+    plt.tight_layout()
+    plt.show()
+
+
+if __name__ == "__main__":
+    main()
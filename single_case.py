@@ -1,7 +1,8 @@
 import xml.etree.ElementTree as ET
 import os
 import subprocess
-import pandas as pd
+import flow_template
+from sumo_interface import parse_emission_data as parse_emission_data_stream
 
 # 🛠 Định nghĩa đường dẫn đến các file đầu vào
 NETWORK_FILE = "simpleT.net.xml"
@@ -9,6 +10,15 @@ ROUTE_FILE = "simpleT.rou.xml"
 CONFIG_FILE = "simpleT.sumocfg"
 EMISSION_FILE = "emissions_data.xml"
 
+# 🛠 Thuộc tính phát thải của SUMO -> tên cột kết quả
+EMISSION_COLUMNS = {
+    "CO2": "CO2 (g)",
+    "CO": "CO (g)",
+    "NOx": "NOx (g)",
+    "PMx": "PMx (g)",
+    "fuel": "Fuel (L)"
+}
+
 # 🛠 Thư mục chứa file đầu ra
 OUTPUT_FOLDER = "output/"
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
@@ -28,41 +38,11 @@ def check_input_files():
         return False
     return True
 
-# 🛠 Lấy tổng số lượng xe hiện có từ .rou.xml
-def get_total_vehicles(root, vehicle_types):
-    """Lấy tổng số lượng xe hiện có trong file .rou.xml."""
-    total_vehicles = 0
-    vehicle_counts = {vtype: 0 for vtype in vehicle_types}
-    
-    for flow in root.findall("flow"):
-        vtype = flow.get("type")
-        if vtype in vehicle_counts:
-            count = int(flow.get("number"))
-            vehicle_counts[vtype] += count
-            total_vehicles += count
-
-    return total_vehicles, vehicle_counts
-
 # 🛠 Điều chỉnh số lượng xe theo phần trăm nhập vào
 def adjust_vehicle_numbers(xml_file, output_file, new_percentages):
     """Điều chỉnh số lượng xe trong file .rou.xml theo phần trăm do người dùng nhập vào."""
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-
-    vehicle_types = new_percentages.keys()
-    total_vehicles, vehicle_counts = get_total_vehicles(root, vehicle_types)
-
-    # Tính toán số lượng xe mới theo phần trăm người dùng nhập
-    new_counts = {vtype: int((new_percentages[vtype] / 100) * total_vehicles) for vtype in vehicle_types}
-
-    for flow in root.findall("flow"):
-        vtype = flow.get("type")
-        if vtype in new_counts:
-            original_count = int(flow.get("number"))
-            type_ratio = original_count / vehicle_counts[vtype] if vehicle_counts[vtype] > 0 else 1
-            flow.set("number", str(max(1, int(new_counts[vtype] * type_ratio))))  # Cập nhật số lượng xe
-
-    tree.write(output_file, encoding="utf-8", xml_declaration=True)
+    # File .rou.xml chỉ được phân tích một lần thành template, sau đó chỉ ghép số lượng xe mới
+    flow_template.adjust_vehicle_numbers(xml_file, output_file, new_percentages)
     print(f"✅ Updated .rou.xml saved as: {output_file}")
 
 # 🛠 Cập nhật file cấu hình SUMO để sử dụng file route mới
@@ -102,27 +82,7 @@ def parse_emission_data(emission_file):
         print(f"❌ No emission data found for {emission_file}. Skipping...")
         return None
 
-    tree = ET.parse(emission_file)
-    root = tree.getroot()
-
-    total_emissions = {
-        "CO2 (g)": 0,
-        "CO (g)": 0,
-        "NOx (g)": 0,
-        "PMx (g)": 0,
-        "Fuel (L)": 0
-    }
-
-    for timestep in root.findall("timestep"):
-        for vehicle in timestep.findall("vehicle"):
-            total_emissions["CO2 (g)"] += float(vehicle.get("CO2", 0))
-            total_emissions["CO (g)"] += float(vehicle.get("CO", 0))
-            total_emissions["NOx (g)"] += float(vehicle.get("NOx", 0))
-            total_emissions["PMx (g)"] += float(vehicle.get("PMx", 0))
-            total_emissions["Fuel (L)"] += float(vehicle.get("fuel", 0))
-
-    df = pd.DataFrame([total_emissions])
-    return df
+    return parse_emission_data_stream(emission_file, EMISSION_COLUMNS)
 
 # 🛠 Lưu dữ liệu vào CSV
 def save_data(df, output_file):
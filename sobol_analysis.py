@@ -0,0 +1,195 @@
+"""Sobol sensitivity analysis of several model outputs at once.
+
+The estimators are those of SALib's sobol.analyze (Saltelli 2010 first and total
+order, Saltelli 2002 second order, outputs normalised by their standard deviation),
+but every index and every bootstrap resample is computed in a few array operations,
+and the outputs (e.g. all pollutants) are analysed in parallel on a process pool. The
+result is one tidy table with a row per output, index and parameter (pair)."""
+
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+
+RESAMPLE_CHUNK_VALUES = 1 << 24  # bootstrap values held in memory at once
+
+
+def _output_blocks(Y, num_vars, calc_second_order=True):
+    """Saltelli ordered outputs as one row per base sample: A, AB_1..AB_D, (BA_1..BA_D,) B"""
+
+    step = 2 * num_vars + 2 if calc_second_order else num_vars + 2
+    if len(Y) % step:
+        raise ValueError(f"{len(Y)} outputs do not form a Saltelli design of {num_vars} "
+                         f"variables (calc_second_order={calc_second_order})")
+    return np.asarray(Y, dtype=float).reshape(-1, step)
+
+
+def _split_blocks(blocks, num_vars, calc_second_order=True):
+    """A (N,), B (N,), AB (N, D) and BA (N, D) or None of output blocks"""
+    BA = blocks[:, num_vars + 1:2 * num_vars + 1] if calc_second_order else None
+    return blocks[:, 0], blocks[:, -1], blocks[:, 1:num_vars + 1], BA
+
+
+def separate_outputs(Y, num_vars, calc_second_order=True):
+    """split Saltelli ordered outputs into A (N,), B (N,), AB (N, D) and BA (N, D) or None"""
+    return _split_blocks(_output_blocks(Y, num_vars, calc_second_order), num_vars,
+                         calc_second_order)
+
+
+def _estimates(A, B, AB, BA):
+    """S1 (..., D), ST (..., D) and S2 (..., D, D) of (resampled) blocks, samples on axis 0"""
+
+    variance = np.var(np.concatenate([A, B]), axis=0)[..., None]
+    variance = np.where(variance > np.finfo(float).eps, variance, np.inf)  # constant output: 0
+    S1 = np.mean(B[..., None] * (AB - A[..., None]), axis=0) / variance
+    ST = 0.5 * np.mean((A[..., None] - AB) ** 2, axis=0) / variance
+    if BA is None:
+        return S1, ST, None
+    Vjk = (np.einsum("n...j,n...k->...jk", BA, AB) / len(A)
+           - np.mean(A * B, axis=0)[..., None, None]) / variance[..., None]
+    return S1, ST, Vjk - S1[..., :, None] - S1[..., None, :]
+
+
+def sobol_indices(Y, num_vars, calc_second_order=True, num_resamples=100,  # pylint: disable=too-many-arguments,too-many-locals
+                  conf_level=0.95, seed=None):
+    """Sobol indices of one output in SALib's format (S1, ST, S2 and *_conf), with the
+    bootstrap confidence intervals of all indices computed together.
+
+    Base samples with a missing (NaN) output, e.g. of an unfinished or failed run, are
+    left out: the remaining ones still form a valid, smaller design."""
+
+    blocks = _output_blocks(Y, num_vars, calc_second_order)
+    blocks = blocks[~np.isnan(blocks).any(axis=1)]
+    blocks = (blocks - blocks.mean()) / blocks.std()
+    A, B, AB, BA = _split_blocks(blocks, num_vars, calc_second_order)
+    num_samples = len(A)
+    S1, ST, S2 = _estimates(A, B, AB, BA)
+
+    resamples = np.random.default_rng(seed).integers(num_samples,
+                                                     size=(num_samples, num_resamples))
+    chunk = max(1, RESAMPLE_CHUNK_VALUES // (num_samples * num_vars * (num_vars + 1)))
+    estimates = [[], [], []]
+    for start in range(0, num_resamples, chunk):
+        r = resamples[:, start:start + chunk]
+        for values, estimate in zip(estimates, _estimates(
+                A[r], B[r], AB[r], None if BA is None else BA[r])):
+            values.append(estimate)
+
+    z = norm.ppf(0.5 + conf_level / 2)
+    Si = {"S1": S1, "S1_conf": z * np.concatenate(estimates[0]).std(axis=0, ddof=1),
+          "ST": ST, "ST_conf": z * np.concatenate(estimates[1]).std(axis=0, ddof=1)}
+    if calc_second_order:
+        upper = np.triu(np.ones((num_vars, num_vars), dtype=bool), k=1)
+        Si["S2"] = np.where(upper, S2, np.nan)
+        Si["S2_conf"] = np.where(upper, z * np.concatenate(estimates[2]).std(axis=0, ddof=1),
+                                 np.nan)
+    return Si
+
+
+def tidy_indices(Si, names, output):
+    """rows (output, index, parameter, parameter_2, value, conf) of one output's indices"""
+
+    rows = []
+    for index in ("S1", "ST"):
+        rows += [(output, index, name, "", value, conf)
+                 for name, value, conf in zip(names, Si[index], Si[f"{index}_conf"])]
+    if "S2" in Si:
+        for j, k in zip(*np.triu_indices(len(names), k=1)):
+            rows.append((output, "S2", names[j], names[k], Si["S2"][j, k], Si["S2_conf"][j, k]))
+    return rows
+
+
+def _analyze_output(args):
+    """process pool task: indices of one output"""
+    output, Y, num_vars, calc_second_order, num_resamples, conf_level, seed = args
+    return output, sobol_indices(Y, num_vars, calc_second_order, num_resamples, conf_level, seed)
+
+
+def analyze_outputs(problem, outputs, calc_second_order=True, num_resamples=1000,  # pylint: disable=too-many-arguments
+                    conf_level=0.95, seed=None, workers=1):
+    """Sobol indices of every column of outputs (a DataFrame in design order).
+
+    Returns the tidy table of all indices (columns output, index, parameter,
+    parameter_2, value, conf) and a dict of the SALib style indices per output."""
+
+    tasks = [(name, outputs[name].to_numpy(dtype=float), problem['num_vars'],
+              calc_second_order, num_resamples, conf_level, seed) for name in outputs.columns]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+            results = dict(pool.map(_analyze_output, tasks))
+    else:
+        results = dict(map(_analyze_output, tasks))
+
+    rows = [row for name in outputs.columns
+            for row in tidy_indices(results[name], problem['names'], name)]
+    table = pd.DataFrame(rows, columns=["output", "index", "parameter", "parameter_2",
+                                        "value", "conf"])
+    return table, results
+
+
+def _write_status(status_file, status):
+    """replace the status file atomically, so readers never see a partial file"""
+    temporary = f"{status_file}.{os.getpid()}.tmp"
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump(status, file, indent=1)
+    os.replace(temporary, status_file)
+
+
+def live_sobol_monitor(problem, status_file, output_column=None, calc_second_order=True,  # pylint: disable=too-many-arguments
+                       publish_every=8, stable_updates=3, stop_when_stable=False,
+                       num_resamples=200, seed=None):
+    """callback on_result(design index, outputs) that estimates the indices of a Saltelli
+    design while it is still being simulated, e.g. sweep.run_sweep(on_result=...).
+
+    Runs are collected into base sample blocks (A, AB_i, BA_i, B rows); every
+    publish_every newly completed blocks S1 / ST and their confidence intervals are
+    estimated from all complete blocks and written to status_file (JSON) together with
+    the ranking of the parameters by ST and for how many updates it has not changed.
+    With stop_when_stable the callback returns True, asking the sweep to stop, once
+    the ranking has been unchanged for stable_updates updates."""
+
+    num_vars = problem['num_vars']
+    step = 2 * num_vars + 2 if calc_second_order else num_vars + 2
+    blocks, complete = {}, []
+    state = {"published": 0, "ranking": None, "stable": 0, "runs": 0, "start": time.time()}
+
+    def publish():
+        """estimate the indices from the complete blocks and write the status file"""
+        Y = np.concatenate([blocks[block] for block in sorted(complete)])
+        Si = sobol_indices(Y, num_vars, calc_second_order, num_resamples, seed=seed)
+        ranking = [problem['names'][i] for i in np.argsort(-Si["ST"], kind="stable")]
+        state["stable"] = state["stable"] + 1 if ranking == state["ranking"] else 0
+        state["ranking"], state["published"] = ranking, len(complete)
+        _write_status(status_file, {
+            "updated": time.time(),
+            "elapsed_seconds": time.time() - state["start"],
+            "runs": state["runs"],
+            "complete_blocks": len(complete),
+            **{index: {name: [float(value), float(conf)] for name, value, conf in
+                       zip(problem['names'], Si[index], Si[f"{index}_conf"])}
+               for index in ("S1", "ST")},
+            "ranking": ranking,
+            "stable_updates": state["stable"],
+        })
+        print(f"Live Sobol: {len(complete)} complete blocks, ranking by ST {ranking} "
+              f"(unchanged for {state['stable']} updates)")
+
+    def on_result(index, outputs):
+        """record one finished run, return True if the sweep can stop"""
+        value = outputs if output_column is None else outputs[output_column]
+        if np.isnan(value):
+            return False
+        state["runs"] += 1
+        block = blocks.setdefault(index // step, np.full(step, np.nan))
+        block[index % step] = value
+        if not np.isnan(block).any():
+            complete.append(index // step)
+            if len(complete) - state["published"] >= publish_every:
+                publish()
+        return stop_when_stable and state["stable"] >= stable_updates
+
+    return on_result
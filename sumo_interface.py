@@ -2,46 +2,529 @@
 
 import subprocess
 import os
+import gzip
+import json
+import time
+import xml.parsers.expat
 import xml.etree.ElementTree as ET
+import numpy as np
 import pandas as pd
 
 
-def run_sumo_simulation(config_file):
-    """Run SUMO simulation with the specified configuration file"""
+# emission attribute written by SUMO -> column name of the totals DataFrame
+EMISSION_COLUMNS = {
+    "CO2": "Total CO2 (g)",
+    "CO": "Total CO (g)",
+    "HC": "Total HC (g)",
+    "NOx": "Total NOx (g)",
+    "PMx": "Total PMx (g)",
+    "fuel": "Total Fuel (L)"
+}
+
+CHUNK_SIZE = 1 << 20  # bytes fed to the XML parser at a time
+
+
+def run_sumo_simulation(config_file, cwd=None, seed=None):
+    """Run SUMO simulation with the specified configuration file (and random seed)"""
     sumo_command = ["sumo", "-c", config_file]
-    subprocess.run(sumo_command, check=False)
+    if seed is not None:
+        sumo_command += ["--seed", str(seed)]
+    subprocess.run(sumo_command, check=False, cwd=cwd)
+
+
+def write_sumo_config(template_file, config_file, **options):
+    """copy a .sumocfg file, overriding option values.
+
+    options are given with underscores instead of dashes, e.g.
+    write_sumo_config(template, out, net_file=..., route_files=..., emission_output=...).
+    Options missing from the template are added to its <processing> section.
+    Relative paths are resolved by SUMO against the folder of config_file."""
+
+    tree = ET.parse(template_file)
+    root = tree.getroot()
+
+    for name, value in options.items():
+        name = name.replace("_", "-")
+        elements = root.findall(f".//{name}")
+        if not elements:
+            processing = root.find("processing")
+            if processing is None:
+                processing = ET.SubElement(root, "processing")
+            elements = [ET.SubElement(processing, name)]
+        for elem in elements:
+            elem.set("value", str(value))
+
+    tree.write(config_file, encoding="utf-8", xml_declaration=True)
+
+
+def read_sumo_config_option(config_file, name, default=None):
+    """value of an option in a .sumocfg file (e.g. 'emission-output'), or default.
+    Paths are returned as written, i.e. relative to the folder of config_file"""
+
+    elem = ET.parse(config_file).getroot().find(f".//{name}")
+    return default if elem is None else elem.get("value", default)
+
+
+def _read_chunks(xml_file, chunk_size=CHUNK_SIZE):
+    """read a (optionally gzipped) xml file in fixed size binary chunks"""
+    opener = gzip.open if xml_file.endswith(".gz") else open
+    with opener(xml_file, "rb") as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def tail_chunks(xml_file, process, chunk_size=CHUNK_SIZE, poll_interval=0.05):
+    """read a file (or FIFO) in binary chunks while process is still writing it.
+
+    Waits for the file to appear, yields data as soon as it is written and stops once
+    process has exited and everything it wrote has been read."""
+
+    while not os.path.exists(xml_file):
+        if process.poll() is not None:
+            return
+        time.sleep(poll_interval)
+
+    descriptor = os.open(xml_file, os.O_RDONLY | os.O_NONBLOCK)  # never block on a FIFO
+    with os.fdopen(descriptor, "rb", buffering=0) as file:
+        while True:
+            running = process.poll() is None  # checked first: a final read follows the exit
+            try:
+                chunk = file.read(chunk_size)
+            except BlockingIOError:
+                chunk = None
+            if chunk:
+                yield chunk
+            elif not running:
+                return
+            else:
+                time.sleep(poll_interval)
+
+
+def iter_xml_records(chunks, tag, parent_tag=None, parent_attr=None):
+    """stream the attributes of every <tag> element from an iterable of xml byte chunks.
+
+    Elements are never built: expat reports each start tag and only the attribute
+    dicts of the current chunk are buffered, so memory stays constant whatever the
+    file size. If parent_tag is given, each record is yielded as (value, attributes)
+    where value is the parent_attr of the enclosing <parent_tag> element."""
+
+    records = []
+    parent = [None]
+
+    def start_element(name, attrs):
+        if name == tag:
+            records.append(attrs if parent_tag is None else (parent[0], attrs))
+        elif name == parent_tag:
+            parent[0] = attrs.get(parent_attr)
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start_element
 
-def parse_emission_data(emission_file):
-    """Parse SUMO emission file and extracts vehicle emissions data"""
+    for chunk in chunks:
+        parser.Parse(chunk, False)
+        yield from records
+        records.clear()
+    parser.Parse(b"", True)
+    yield from records
+
+
+def iter_emission_records(emission_file, chunk_size=CHUNK_SIZE):
+    """stream (time, vehicle attributes) for every vehicle record of a SUMO emission file"""
+    for time, vehicle in iter_xml_records(_read_chunks(emission_file, chunk_size),
+                                          "vehicle", "timestep", "time"):
+        yield float(time), vehicle
+
+
+def sum_emissions(records, columns=None):
+    """sum the emission attributes of vehicle records into a one row DataFrame.
+
+    columns maps SUMO attribute names to output column names (EMISSION_COLUMNS by
+    default). Returns the DataFrame and the number of records consumed."""
+
+    columns = EMISSION_COLUMNS if columns is None else columns
+    attributes = list(columns)
+    sums = [0.0] * len(attributes)
+    count = 0
+    for _, vehicle in records:
+        count += 1
+        for i, attribute in enumerate(attributes):
+            value = vehicle.get(attribute)
+            if value is not None:
+                sums[i] += float(value)
+
+    df = pd.DataFrame([dict(zip(columns.values(), sums))])
+    return df, count
+
+
+def parse_emission_data(emission_file, columns=None):
+    """Parse SUMO emission file and extracts vehicle emissions data.
+
+    The file is streamed so memory use does not depend on its size."""
 
     if not os.path.exists(emission_file):
         print(f"❌ No emission data found for {emission_file}. Skipping...")
         return None
 
-    tree = ET.parse(emission_file)
-    root = tree.getroot()
+    df, _ = sum_emissions(iter_emission_records(emission_file), columns)
+    return df
+
+
+# columns of the emission store: name -> dtype. Categorical columns hold int codes into
+# the dictionaries saved next to them, the pollutant columns use the SUMO attribute names
+STORE_COLUMNS = {
+    "time": "f8",
+    "vehicle": "i4",
+    "type": "i4",
+    "lane": "i4",
+    "x": "f4",
+    "y": "f4",
+    "speed": "f4",
+    **{attribute: "f8" for attribute in EMISSION_COLUMNS}
+}
+CATEGORICAL_COLUMNS = ("vehicle", "type", "lane")
+STORE_CHUNK_ROWS = 1 << 18  # rows converted or aggregated at a time
+
+
+def vehicle_type(vehicle):
+    """type of a vehicle record, from its type attribute or else its id
+    (e.g. 'pkw_12' from random_route or 'pkw12.0' from a flow)"""
+    vtype = vehicle.get("type")
+    if vtype:
+        return vtype
+    vehicle_id = vehicle.get("id", "")
+    return vehicle_id.split("_")[0].split(".")[0].rstrip("0123456789") or vehicle_id
+
+
+def _flush_store_chunk(buffers, raw_files):
+    """append the buffered rows of every column to its raw binary file"""
+    for name, values in buffers.items():
+        np.asarray(values, dtype=STORE_COLUMNS[name]).tofile(raw_files[name])
+        values.clear()
+
+
+def convert_emissions_to_store(emission_file, store_dir, chunk_rows=STORE_CHUNK_ROWS):
+    """convert a SUMO emission file once into a folder of memory mappable .npy columns.
+
+    The file is streamed and written chunk by chunk, so the conversion runs in bounded
+    memory; vehicle ids, types and lanes are dictionary encoded. Returns the number of rows."""
+
+    os.makedirs(store_dir, exist_ok=True)
+    dictionaries = {name: {} for name in CATEGORICAL_COLUMNS}
+    buffers = {name: [] for name in STORE_COLUMNS}
+    raw_names = {name: os.path.join(store_dir, f"{name}.bin") for name in STORE_COLUMNS}
+    raw_files = {name: open(path, "wb") for name, path in raw_names.items()}  # pylint: disable=consider-using-with
+
+    rows = 0
+    try:
+        for time, vehicle in iter_emission_records(emission_file):
+            buffers["time"].append(time)
+            for name, value in (("vehicle", vehicle.get("id", "")),
+                                ("type", vehicle_type(vehicle)),
+                                ("lane", vehicle.get("lane", ""))):
+                codes = dictionaries[name]
+                buffers[name].append(codes.setdefault(value, len(codes)))
+            for name in ("x", "y", "speed", *EMISSION_COLUMNS):
+                buffers[name].append(float(vehicle.get(name, 0)))
+            rows += 1
+            if rows % chunk_rows == 0:
+                _flush_store_chunk(buffers, raw_files)
+        _flush_store_chunk(buffers, raw_files)
+    finally:
+        for file in raw_files.values():
+            file.close()
+
+    # wrap the raw columns into .npy files, copying chunk by chunk
+    for name, path in raw_names.items():
+        column = np.lib.format.open_memmap(os.path.join(store_dir, f"{name}.npy"), mode="w+",
+                                           dtype=STORE_COLUMNS[name], shape=(rows,))
+        if rows:
+            raw = np.memmap(path, dtype=STORE_COLUMNS[name], mode="r", shape=(rows,))
+            for start in range(0, rows, chunk_rows):
+                column[start:start + chunk_rows] = raw[start:start + chunk_rows]
+            del raw
+        column.flush()
+        del column
+        os.remove(path)
+
+    with open(os.path.join(store_dir, "store.json"), "w", encoding="utf-8") as file:
+        json.dump({"source": os.path.abspath(emission_file), "rows": rows,
+                   "columns": STORE_COLUMNS,
+                   "dictionaries": {name: list(codes) for name, codes in dictionaries.items()}},
+                  file)
+    return rows
 
-    # Initialize total sums
-    total_emissions = {
-        "Total CO2 (g)": 0,
-        "Total CO (g)": 0,
-        "Total HC (g)": 0,
-        "Total NOx (g)": 0,
-        "Total PMx (g)": 0,
-        "Total Fuel (L)": 0
-    }
 
-    # Extract and sum emissions
-    for timestep in root.findall("timestep"):
-        for vehicle in timestep.findall("vehicle"):
-            total_emissions["Total CO2 (g)"] += float(vehicle.get("CO2", 0))
-            total_emissions["Total CO (g)"] += float(vehicle.get("CO", 0))
-            total_emissions["Total HC (g)"] += float(vehicle.get("HC", 0))
-            total_emissions["Total NOx (g)"] += float(vehicle.get("NOx", 0))
-            total_emissions["Total PMx (g)"] += float(vehicle.get("PMx", 0))
-            total_emissions["Total Fuel (L)"] += float(vehicle.get("fuel", 0))
+def load_emission_store(store_dir):
+    """open an emission store; the columns are read only memory maps, nothing is loaded"""
 
-    # Convert to DataFrame
-    df = pd.DataFrame([total_emissions])
+    with open(os.path.join(store_dir, "store.json"), encoding="utf-8") as file:
+        store = json.load(file)
+    store["data"] = {name: np.load(os.path.join(store_dir, f"{name}.npy"), mmap_mode="r")
+                     for name in store["columns"]}
+    return store
 
+
+def _unique_groups(keys, sizes):
+    """distinct rows of group codes keys (n, dimensions) in lexicographic order and the
+    group of every row; rows are compared as one combined code where it fits an int64"""
+
+    if keys.shape[1] == 0:
+        return keys[:1], np.zeros(len(keys), dtype=np.int64)
+    try:
+        codes = np.ravel_multi_index(keys.T, sizes)
+    except ValueError:  # more combinations than an int64 holds
+        return np.unique(keys, axis=0, return_inverse=True)
+    codes, inverse = np.unique(codes, return_inverse=True)
+    return np.stack(np.unravel_index(codes, sizes), axis=1), inverse
+
+
+def _merge_groups(keys, sums, counts, sizes):
+    """add up the partial sums and counts of the same groups"""
+    keys, inverse = _unique_groups(np.concatenate(keys), sizes)
+    sums = np.concatenate(sums)
+    sums = np.stack([np.bincount(inverse, weights=sums[:, i], minlength=len(keys))
+                     for i in range(sums.shape[1])], axis=1)
+    return keys, sums, np.bincount(inverse, weights=np.concatenate(counts), minlength=len(keys))
+
+
+def aggregate_emission_store(store, by=(), time_bin=None, pollutants=None,  # pylint: disable=too-many-locals
+                             chunk_rows=STORE_CHUNK_ROWS):
+    """sum pollutants over an emission store grouped by any of 'vehicle', 'type', 'lane'
+    and, if time_bin (seconds) is given, by time bin.
+
+    Each chunk of rows is reduced to the groups it contains (np.unique of their codes
+    and one np.bincount per pollutant), and the partial sums are merged as they pile up,
+    so memory is bounded by chunk_rows and the number of groups that actually occur, not
+    by all combinations of the dimensions. Returns a DataFrame with one row per non
+    empty group and a column per pollutant (named as in EMISSION_COLUMNS)."""
+
+    by = [by] if isinstance(by, str) else list(by)
+    pollutants = list(EMISSION_COLUMNS) if pollutants is None else list(pollutants)
+    data, rows = store["data"], store["rows"]
+
+    sizes = [len(store["dictionaries"][name]) for name in by]
+    if time_bin is not None:
+        last = float(data["time"][-1]) if rows else 0.0  # emission output is time ordered
+        sizes.append(int(last // time_bin) + 1)
+
+    keys, sums, counts = [], [], []
+    merged = pending = 0
+    for start in range(0, rows, chunk_rows):
+        chunk = slice(start, start + chunk_rows)
+        columns = [np.asarray(data[name][chunk], dtype=np.int64) for name in by]
+        if time_bin is not None:
+            columns.append((data["time"][chunk] // time_bin).astype(np.int64))
+        chunk_keys, inverse = _unique_groups(
+            np.stack(columns, axis=1) if columns else np.zeros((len(data["time"][chunk]), 0),
+                                                               dtype=np.int64), sizes)
+        keys.append(chunk_keys)
+        counts.append(np.bincount(inverse, minlength=len(chunk_keys)))
+        sums.append(np.stack([np.bincount(inverse, weights=data[p][chunk],
+                                          minlength=len(chunk_keys)) for p in pollutants], axis=1))
+        pending += len(chunk_keys)
+        if pending > max(chunk_rows, merged):  # merged groups grow, merges become rarer
+            merged_keys, merged_sums, merged_counts = _merge_groups(keys, sums, counts, sizes)
+            keys, sums, counts = [merged_keys], [merged_sums], [merged_counts]
+            merged = pending = len(merged_keys)
+
+    if keys:
+        keys, sums, _ = _merge_groups(keys, sums, counts, sizes)
+    else:  # empty store: no groups, or the one total
+        keys = np.zeros((0 if sizes else 1, len(sizes)), dtype=np.int64)
+        sums = np.zeros((len(keys), len(pollutants)))
+
+    df = pd.DataFrame({EMISSION_COLUMNS.get(p, p): sums[:, i] for i, p in enumerate(pollutants)})
+    index = []
+    for name, codes in zip(by + (["time"] if time_bin is not None else []), keys.T):
+        if name == "time":
+            index.append(pd.Series(codes * time_bin, name=f"time bin ({time_bin} s)"))
+        else:
+            index.append(pd.Series(np.asarray(store["dictionaries"][name])[codes], name=name))
+    if index:
+        df.index = pd.MultiIndex.from_arrays(index) if len(index) > 1 else pd.Index(index[0])
     return df
+
+
+# breakdowns computed by aggregate_emissions by default: name -> grouping dimensions
+DEFAULT_BREAKDOWNS = {
+    "type": ("type",),
+    "lane": ("lane",),
+    "time": ("time",),
+    "type_time": ("type", "time"),
+}
+
+
+def _records_frame(records, time_bin, pollutants):
+    """DataFrame of a chunk of vehicle records with every grouping dimension"""
+    times, vehicles = zip(*records)
+    lanes = [vehicle.get("lane", "") for vehicle in vehicles]
+    frame = {
+        "time": np.floor(np.asarray(times) / time_bin) * time_bin,
+        "vehicle": [vehicle.get("id", "") for vehicle in vehicles],
+        "type": [vehicle_type(vehicle) for vehicle in vehicles],
+        "lane": lanes,
+        "edge": [lane.rsplit("_", 1)[0] for lane in lanes],
+    }
+    for attribute in pollutants:
+        frame[attribute] = np.fromiter((float(vehicle.get(attribute, 0)) for vehicle in vehicles),
+                                       dtype=float, count=len(vehicles))
+    return pd.DataFrame(frame)
+
+
+def aggregate_emissions(records, breakdowns=None, time_bin=60, columns=None,
+                        chunk_rows=STORE_CHUNK_ROWS // 4):
+    """compute several emission breakdowns in a single pass over vehicle records.
+
+    breakdowns maps a name to the dimensions to group by, any of 'type' (from the type
+    attribute or else the vehicle id), 'vehicle', 'lane', 'edge' and 'time' (start of the
+    time_bin second bin); DEFAULT_BREAKDOWNS gives per type, lane, time bin and type x bin.
+    Records are grouped chunk by chunk so memory only grows with the number of groups.
+    Returns {name: tidy DataFrame with the dimensions and one column per pollutant}."""
+
+    breakdowns = DEFAULT_BREAKDOWNS if breakdowns is None else breakdowns
+    columns = EMISSION_COLUMNS if columns is None else columns
+    pollutants = list(columns)
+    partials = dict.fromkeys(breakdowns)
+
+    def reduce_chunk(chunk):
+        frame = _records_frame(chunk, time_bin, pollutants)
+        for name, dimensions in breakdowns.items():
+            sums = frame.groupby(list(dimensions), sort=False)[pollutants].sum()
+            partials[name] = sums if partials[name] is None else \
+                partials[name].add(sums, fill_value=0)
+
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_rows:
+            reduce_chunk(chunk)
+            chunk = []
+    if chunk:
+        reduce_chunk(chunk)
+
+    results = {}
+    for name, dimensions in breakdowns.items():
+        sums = partials[name]
+        if sums is None:
+            sums = pd.DataFrame(columns=list(dimensions) + pollutants).set_index(list(dimensions))
+        results[name] = sums.sort_index().reset_index().rename(columns=columns)
+    return results
+
+
+def parse_emission_breakdowns(emission_file, breakdowns=None, time_bin=60):
+    """breakdowns of a SUMO emission file (see aggregate_emissions), or None if it is missing"""
+
+    if not os.path.exists(emission_file):
+        print(f"❌ No emission data found for {emission_file}. Skipping...")
+        return None
+    return aggregate_emissions(iter_emission_records(emission_file), breakdowns, time_bin)
+
+
+# numeric tripinfo attributes loaded by load_tripinfo (per vehicle emission totals come
+# from the nested <emissions> element)
+TRIPINFO_COLUMNS = ["depart", "arrival", "duration", "routeLength", "waitingTime", "timeLoss",
+                    "departDelay", "CO2_abs", "CO_abs", "HC_abs", "NOx_abs", "PMx_abs",
+                    "fuel_abs"]
+
+
+def iter_tripinfo_records(tripinfo_file, chunk_size=CHUNK_SIZE):
+    """stream the attributes of every <tripinfo>, merged with those of its <emissions>"""
+
+    records = []
+    current = [None]
+
+    def start_element(name, attrs):
+        if name == "tripinfo":
+            current[0] = attrs
+        elif name == "emissions" and current[0] is not None:
+            current[0].update(attrs)
+
+    def end_element(name):
+        if name == "tripinfo":
+            records.append(current[0])
+            current[0] = None
+
+    parser = xml.parsers.expat.ParserCreate()
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    for chunk in _read_chunks(tripinfo_file, chunk_size):
+        parser.Parse(chunk, False)
+        yield from records
+        records.clear()
+    parser.Parse(b"", True)
+    yield from records
+
+
+def iter_tripinfo_chunks(tripinfo_file, chunk_rows=STORE_CHUNK_ROWS):
+    """stream a tripinfo file as typed DataFrames of at most chunk_rows vehicles.
+
+    Columns: id, flow (the id up to its first '.', empty for non flow vehicles), vType
+    and the float columns of TRIPINFO_COLUMNS (NaN where an attribute is missing)."""
+
+    def frame(records):
+        ids = [record.get("id", "") for record in records]
+        data = {
+            "id": ids,
+            "flow": pd.Categorical([i.split(".")[0] if "." in i else "" for i in ids]),
+            "vType": pd.Categorical([record.get("vType", "") for record in records]),
+        }
+        for name in TRIPINFO_COLUMNS:
+            data[name] = np.fromiter((float(record.get(name, "nan")) for record in records),
+                                     dtype=float, count=len(records))
+        return pd.DataFrame(data)
+
+    chunk = []
+    for record in iter_tripinfo_records(tripinfo_file):
+        chunk.append(record)
+        if len(chunk) == chunk_rows:
+            yield frame(chunk)
+            chunk = []
+    if chunk:
+        yield frame(chunk)
+
+
+def load_tripinfo(tripinfo_file):
+    """load a SUMO tripinfo file into a typed DataFrame (see iter_tripinfo_chunks)"""
+
+    chunks = list(iter_tripinfo_chunks(tripinfo_file))
+    if not chunks:
+        return pd.DataFrame(columns=["id", "flow", "vType"] + TRIPINFO_COLUMNS)
+    return pd.concat(chunks, ignore_index=True).astype({"flow": "category", "vType": "category"})
+
+
+def tripinfo_statistics(tripinfo, by=("flow", "vType"), columns=None):
+    """vehicle count and mean / min / max of tripinfo columns per group
+    (missing values are left out of the statistics).
+
+    tripinfo is a DataFrame from load_tripinfo or an iterable of chunks from
+    iter_tripinfo_chunks; chunks are reduced one at a time, so statistics over files
+    with millions of vehicles never hold more than one chunk in memory."""
+
+    by = [by] if isinstance(by, str) else list(by)
+    columns = ["duration", "routeLength", "waitingTime", "timeLoss", "departDelay"] \
+        if columns is None else list(columns)
+    chunks = [tripinfo] if isinstance(tripinfo, pd.DataFrame) else tripinfo
+
+    count = valid = total = minimum = maximum = None
+    for chunk in chunks:
+        groups = chunk.groupby(by, observed=True)[columns]
+        partial = (groups.size(), groups.count(), groups.sum(), groups.min(), groups.max())
+        if count is None:
+            count, valid, total, minimum, maximum = partial
+        else:
+            count = count.add(partial[0], fill_value=0)
+            valid = valid.add(partial[1], fill_value=0)
+            total = total.add(partial[2], fill_value=0)
+            minimum = pd.concat([minimum, partial[3]]).groupby(level=by).min()
+            maximum = pd.concat([maximum, partial[4]]).groupby(level=by).max()
+    if count is None:
+        return pd.DataFrame()
+
+    mean = total / valid.where(valid > 0)  # over the non missing values of each column
+    stats = pd.concat({"mean": mean, "min": minimum, "max": maximum}, axis=1)
+    stats.insert(0, "vehicles", count.astype(int))
+    return stats.sort_index()
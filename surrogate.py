@@ -0,0 +1,112 @@
+"""Polynomial chaos surrogate of the simulation for cheap Sobol sensitivity analysis.
+
+Emissions are emulated as a sparse sum of orthonormal Legendre polynomials of the
+[0, 1] design variables, fitted by least squares on a small space filling design. The
+degree is chosen by leave-one-out cross validation, and the Sobol indices follow
+analytically from the coefficients: every polynomial term contributes its squared
+coefficient to the variance of the variables it depends on."""
+
+import itertools
+import numpy as np
+from scipy.stats import norm
+
+
+def multi_indices(num_vars, degree):
+    """polynomial degrees per variable of every term of total degree <= degree"""
+    terms = [alpha for alpha in itertools.product(range(degree + 1), repeat=num_vars)
+             if sum(alpha) <= degree]
+    return np.array(sorted(terms, key=lambda alpha: (sum(alpha), alpha[::-1])))
+
+
+def pce_basis(X, indices):
+    """evaluate the orthonormal Legendre terms on design points X in [0, 1]^d"""
+
+    X = np.atleast_2d(X)
+    degree = int(indices.max())
+    scale = np.sqrt(2 * np.arange(degree + 1) + 1)  # orthonormal for uniform [0, 1]
+    univariate = np.polynomial.legendre.legvander(2 * X - 1, degree) * scale  # (n, d, degree+1)
+    columns = univariate[:, np.arange(X.shape[1]), indices]  # (n, terms, d)
+    return columns.prod(axis=2)
+
+
+def fit_pce(X, y, degree):
+    """least squares polynomial chaos fit; returns the model and its leave-one-out Q²"""
+
+    indices = multi_indices(X.shape[1], degree)
+    basis = pce_basis(X, indices)
+    coefficients, *_ = np.linalg.lstsq(basis, y, rcond=None)
+
+    # leave-one-out residuals from the diagonal of the hat matrix
+    q, _ = np.linalg.qr(basis)
+    leverage = np.minimum((q ** 2).sum(axis=1), 1 - 1e-12)
+    loo_residuals = (y - basis @ coefficients) / (1 - leverage)
+    q2 = 1 - np.mean(loo_residuals ** 2) / np.var(y)
+    return {"indices": indices, "coefficients": coefficients, "q2": q2}
+
+
+def select_pce(X, y, max_degree=5):
+    """fit polynomial chaos expansions of increasing degree and keep the best by LOO Q²
+    (ValueError if there are too few runs for even a linear one)"""
+
+    best = None
+    for degree in range(1, max_degree + 1):
+        if len(multi_indices(X.shape[1], degree)) >= len(y):
+            break  # not enough runs to fit this degree
+        model = fit_pce(X, y, degree)
+        print(f"PCE degree {degree}: {len(model['indices'])} terms, LOO Q² = {model['q2']:.4f}")
+        if best is None or model["q2"] > best["q2"]:
+            best = model
+    if best is None:
+        needed = len(multi_indices(X.shape[1], 1)) + 1
+        raise ValueError(f"a surrogate of {X.shape[1]} variables needs at least {needed} "
+                         f"runs, got {len(y)}")
+    return best
+
+
+def predict_pce(model, X):
+    """evaluate a fitted surrogate, e.g. for Monte Carlo on the surrogate"""
+    return pce_basis(X, model["indices"]) @ model["coefficients"]
+
+
+def _pce_indices(model):
+    """S1, ST and S2 of a polynomial chaos expansion"""
+
+    indices, squared = model["indices"], model["coefficients"] ** 2
+    active = indices > 0
+    order = active.sum(axis=1)
+    variance = squared[order > 0].sum()
+    num_vars = indices.shape[1]
+
+    S1 = np.array([squared[(order == 1) & active[:, i]].sum() for i in range(num_vars)])
+    ST = np.array([squared[active[:, i]].sum() for i in range(num_vars)])
+    S2 = np.full((num_vars, num_vars), np.nan)
+    for i, j in itertools.combinations(range(num_vars), 2):
+        S2[i, j] = squared[(order == 2) & active[:, i] & active[:, j]].sum() / variance
+    return S1 / variance, ST / variance, S2
+
+
+def pce_sobol_indices(X, y, degree, num_resamples=100, conf_level=0.95, seed=None):  # pylint: disable=too-many-arguments
+    """Sobol indices of a degree `degree` surrogate, in the format of SALib's sobol.analyze
+    (S1, ST, S2 and their *_conf half widths). Confidence intervals come from refitting
+    the surrogate on bootstrap resamples of the training runs."""
+
+    S1, ST, S2 = _pce_indices(fit_pce(X, y, degree))
+
+    rng = np.random.default_rng(seed)
+    samples = [_pce_indices(fit_pce(X[rows], y[rows], degree))
+               for rows in rng.integers(0, len(y), (num_resamples, len(y)))]
+    z = norm.ppf(0.5 + conf_level / 2)
+    S1_conf, ST_conf, S2_conf = (z * np.std([sample[k] for sample in samples], axis=0)
+                                 for k in range(3))
+    return {"S1": S1, "S1_conf": S1_conf, "ST": ST, "ST_conf": ST_conf,
+            "S2": S2, "S2_conf": S2_conf}
+
+
+def surrogate_sensitivity(X, y, max_degree=5, num_resamples=100, seed=None):
+    """choose a surrogate for runs (X, y) by cross validation and return its Sobol indices
+    (SALib format, plus the surrogate's "q2") and the fitted model"""
+
+    model = select_pce(X, y, max_degree)
+    Si = pce_sobol_indices(X, y, int(model["indices"].max()), num_resamples, seed=seed)
+    Si["q2"] = model["q2"]
+    return Si, model
@@ -0,0 +1,329 @@
+"""Functions to run the design points of a sensitivity study, optionally in parallel.
+
+Every worker owns an isolated workspace folder holding its own route, config and
+emission files, so design points can be simulated concurrently; the workspaces are
+deleted when the sweep ends. Completed points
+can be recorded in a manifest so an interrupted sweep resumes where it stopped."""
+
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import result_cache
+from random_route import (VEHICLE_CLASSES, VEHICLE_TYPES, generate_route_file,
+                          write_vtype_file)
+from results_store import delete_results, open_results, result_row, write_results
+from simulation_backends import simulate_emissions
+from sumo_interface import EMISSION_COLUMNS, read_sumo_config_option, write_sumo_config
+
+
+_WORKER = {}  # settings and workspace of the current worker process
+
+
+def create_workspace(workspace_root, config_file, net_file, seed=None, vtype_file=None):
+    """create an isolated folder with its own config pointing at the shared network.
+    The vTypes of vtype_file (default: the route files of config_file) are loaded as an
+    additional file, since the generated route file only holds trips. If seed is given
+    SUMO's random seed is pinned to it"""
+
+    folder = tempfile.mkdtemp(prefix=f"worker_{os.getpid()}_", dir=workspace_root)
+    workspace = {
+        "folder": folder,
+        "config": os.path.join(folder, "sweep.sumocfg"),
+        "route": os.path.join(folder, "sweep.rou.xml"),
+        "emission": os.path.join(folder, "emissions_data.xml"),
+        "vtypes": os.path.join(folder, "vtypes.add.xml"),
+    }
+
+    config_folder = os.path.dirname(os.path.abspath(config_file))
+
+    def config_paths(name):
+        """files of a list option of the template config, as absolute paths"""
+        value = read_sumo_config_option(config_file, name, "")
+        return [os.path.join(config_folder, path) for path in value.split(",") if path.strip()]
+
+    write_vtype_file([vtype_file] if vtype_file else config_paths("route-files"),
+                     workspace["vtypes"])
+    additional_files = [os.path.basename(workspace["vtypes"]), *config_paths("additional-files")]
+    options = {"additional_files": ",".join(additional_files)}
+    if seed is not None:
+        options["seed"] = seed
+    write_sumo_config(config_file, workspace["config"],
+                      net_file=os.path.abspath(net_file),
+                      route_files=os.path.basename(workspace["route"]),
+                      emission_output=os.path.basename(workspace["emission"]),
+                      tripinfo_output="data.xml", **options)
+    return workspace
+
+
+def run_design_point(vehicle_proportions, workspace, settings):
+    """generate routes for one design point, simulate it and return the emission totals
+    together with a dict of run information.
+
+    If settings has a cache_dir, SUMO is skipped when a run with identical network,
+    route file, config and seed is already cached (info["cache"] is "hit" or "miss").
+    info["route_seconds"] is the time spent generating the route file."""
+
+    info = {}
+    start = time.perf_counter()
+
+    generate_route_file(
+        net_file=settings["net_file"],
+        route_file=workspace["route"],
+        total_vehicles=settings["total_vehicles"],
+        duration=settings["duration"],
+        vehicle_proportions=vehicle_proportions,
+        seed=settings.get("seed"),
+        pre_route=settings.get("pre_route", False),
+        vehicle_types=settings.get("vehicle_types", VEHICLE_TYPES),
+        vehicle_classes=settings.get("vehicle_classes", VEHICLE_CLASSES),
+        common_random_numbers=settings.get("common_random_numbers", False))
+    info["route_seconds"] = time.perf_counter() - start
+
+    cache_dir = settings.get("cache_dir")
+    if cache_dir:
+        key = result_cache.cache_key(settings["net_file"], workspace["route"],
+                                     workspace["config"], settings.get("seed"),
+                                     settings.get("backend", "subprocess"))
+        cached = result_cache.lookup(cache_dir, key)
+        info["cache"] = "miss" if cached is None else "hit"
+        if cached is not None:
+            return np.array(cached["emissions"], dtype=float), info
+
+    emissions = simulate_emissions(workspace["config"], settings.get("backend", "subprocess"),
+                                   settings.get("seed"))
+    if emissions is not None and cache_dir:
+        raw_files = [workspace["emission"]] if settings.get("cache_raw") and \
+            os.path.isfile(workspace["emission"]) else []
+        result_cache.store(cache_dir, key, {"emissions": emissions.values[0].tolist()},
+                           raw_files, settings.get("cache_max_bytes",
+                                                   result_cache.CACHE_MAX_BYTES))
+    if os.path.exists(workspace["emission"]):  # can be gigabytes, only the totals are kept
+        os.remove(workspace["emission"])
+    if emissions is None:
+        return np.full(len(EMISSION_COLUMNS), np.nan), info
+    return emissions.values[0], info
+
+
+def point_seed(settings, index, replicate=0):
+    """route and SUMO seed of replicate `replicate` of design point `index`.
+
+    Every point gets its own seed derived from settings["seed"], so the noise of the
+    points is independent while reruns of a point are reproducible (and cached). With
+    common_random_numbers all points share the seed (seed + replicate). None if no seed
+    is set, i.e. every run draws fresh random numbers."""
+
+    seed = settings.get("seed")
+    if seed is None:
+        return None
+    if settings.get("common_random_numbers"):
+        return seed + replicate
+    return int(np.random.SeedSequence([seed, index, replicate]).generate_state(1)[0])
+
+
+@contextlib.contextmanager
+def temporary_workspaces(settings):
+    """settings whose workspace_root is a new folder inside the given one; the folder and
+    the worker workspaces created in it are deleted when the block exits"""
+
+    os.makedirs(settings["workspace_root"], exist_ok=True)
+    root = tempfile.mkdtemp(prefix="sweep_", dir=settings["workspace_root"])
+    try:
+        yield dict(settings, workspace_root=root)
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def init_worker(settings):
+    """process pool initializer: set up the workspace of this worker (also called once
+    in the main process for serial runs)"""
+    _WORKER["settings"] = settings
+    _WORKER["workspace"] = create_workspace(
+        settings["workspace_root"], settings["config_file"], settings["net_file"],
+        settings.get("seed"), settings.get("vtype_file"))
+
+
+def run_worker_point(index, vehicle_proportions, replicate=0):
+    """run replicate `replicate` of design point `index` in the workspace of the current
+    worker (see init_worker) with its own seed (see point_seed); returns the emission
+    totals and the run information, which includes its "seconds" and "seed" """
+
+    settings = dict(_WORKER["settings"])
+    settings["seed"] = point_seed(settings, index, replicate)
+    start = time.perf_counter()
+    emissions, info = run_design_point(vehicle_proportions, _WORKER["workspace"], settings)
+    info["seconds"] = time.perf_counter() - start
+    info["seed"] = settings["seed"]
+    return emissions, info
+
+
+def _run_indexed_point(index, vehicle_proportions):
+    """run a design point in the current worker and return it keyed by its design index"""
+    print("Running simulation; ", index)
+    return (index, *run_worker_point(index, vehicle_proportions))
+
+
+def design_hash(vehicle_proportions, settings):
+    """hash of everything that determines the result of a design point"""
+    key = {
+        "counts": [int(count) for count in vehicle_proportions],
+        "total_vehicles": settings["total_vehicles"],
+        "duration": settings["duration"],
+        "net_file": os.path.basename(settings["net_file"]),
+        "config_file": os.path.basename(settings["config_file"]),
+        "seed": settings.get("seed"),
+    }
+    vehicle_types = list(settings.get("vehicle_types", VEHICLE_TYPES))
+    if vehicle_types != VEHICLE_TYPES:  # counts refer to other types than the default ones
+        key["vehicle_types"] = vehicle_types
+    if settings.get("common_random_numbers"):
+        key["common_random_numbers"] = True
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def load_manifest(manifest_file):
+    """read the completed design points of a sweep as {design index: record}"""
+
+    completed = {}
+    if not os.path.exists(manifest_file):
+        return completed
+    with open(manifest_file, encoding="utf-8") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:  # line cut short by a crash
+                continue
+            completed[record["index"]] = record
+    return completed
+
+
+def append_manifest(manifest_file, record):
+    """durably record one completed design point"""
+    with open(manifest_file, mode="a", encoding="utf-8") as file:
+        file.write(json.dumps(record) + "\n")
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def iter_sweep(design_points, settings, workers=1):
+    """simulate (design index, vehicle counts) pairs and yield
+    (design index, emission totals, run information) as they finish.
+
+    settings holds net_file, config_file, total_vehicles, duration and workspace_root,
+    and optionally seed (the base of the points' seeds, see point_seed), pre_route,
+    backend (see simulation_backends.BACKENDS), cache_dir, cache_raw, cache_max_bytes,
+    vehicle_types (the types the counts refer to), vehicle_classes (their SUMO classes,
+    see random_route.get_vehicle_types_from_rou), common_random_numbers (all points
+    share the demand drawn from seed, which also pins SUMO's --seed, and differ only in
+    the vehicle types) and vtype_file (the .rou.xml whose vTypes are loaded, default the
+    route files of config_file).
+    With workers > 1 the points run on a process pool and finish out of order."""
+
+    if settings.get("common_random_numbers") and settings.get("seed") is None:
+        raise ValueError("common random numbers need a fixed seed")
+    with temporary_workspaces(settings) as settings:
+        if workers <= 1:
+            init_worker(settings)
+            for index, vehicle_proportions in design_points:
+                yield _run_indexed_point(index, vehicle_proportions)
+            return
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(settings,)) as pool:
+            futures = [pool.submit(_run_indexed_point, index, vehicle_proportions)
+                       for index, vehicle_proportions in design_points]
+            try:
+                for future in as_completed(futures):
+                    yield future.result()
+            finally:  # closed early: drop the points that have not started
+                for future in futures:
+                    future.cancel()
+
+
+def run_sweep(vehicle_counts, settings, workers=1, manifest_file=None, first_index=0,  # pylint: disable=too-many-arguments,too-many-locals
+              results_db=None, commit_every=64, on_result=None):
+    """simulate every design point and return the emission totals in design order.
+
+    If manifest_file is given, points already recorded there with the same design hash
+    are not simulated again and every newly completed point is appended to it.
+    Failed points (no emission output) are not recorded so a rerun retries them.
+    first_index is the design index of the first row, for designs run in batches.
+    If results_db is given, completed points (counts, seed, emissions and timings) are
+    written to that results database (see results_store), commit_every rows at a time;
+    the rows of points that are simulated again are removed first, so points that fail
+    or are skipped have no row, while points resumed from the manifest keep theirs.
+    on_result(design index, emissions) is called after every finished point (e.g. a
+    sobol_analysis.live_sobol_monitor); if it returns True the sweep stops early, points
+    not yet started are skipped and left NaN."""
+
+    results = np.full((len(vehicle_counts), len(EMISSION_COLUMNS)), np.nan)
+    hashes = [design_hash(counts, settings) for counts in vehicle_counts]
+
+    completed = load_manifest(manifest_file) if manifest_file else {}
+    pending = []
+    for row, vehicle_proportions in enumerate(vehicle_counts):
+        record = completed.get(first_index + row)
+        if record is not None and record["hash"] == hashes[row]:
+            results[row] = record["emissions"]
+        else:
+            pending.append((first_index + row, vehicle_proportions))
+    if manifest_file:
+        print(f"Resuming sweep: {len(vehicle_counts) - len(pending)} of "
+              f"{len(vehicle_counts)} design points already done")
+
+    vehicle_types = settings.get("vehicle_types", VEHICLE_TYPES)
+    connection = open_results(results_db) if results_db else None
+    if connection:  # rows of earlier runs of the points to simulate, maybe of another design
+        delete_results(connection, [index for index, _ in pending])
+        # points resumed from the manifest: add missing rows, existing ones keep their timings
+        resumed_rows = [result_row(first_index + row, vehicle_types, counts, results[row],
+                                   seed=point_seed(settings, first_index + row))
+                        for row, counts in enumerate(vehicle_counts)
+                        if not np.isnan(results[row]).any()]
+        for row in resumed_rows:
+            del row["finished_at"]
+        write_results(connection, resumed_rows, replace=False)
+    rows = []
+
+    if on_result:  # let the callback see the points resumed from the manifest too
+        resumed = [on_result(first_index + row, results[row]) for row in range(len(results))
+                   if not np.isnan(results[row]).any()]
+        if any(resumed):
+            pending = []
+
+    cache_counts = {"hit": 0, "miss": 0}
+    sweep = iter_sweep(pending, settings, workers)
+    for index, emissions, info in sweep:
+        results[index - first_index] = emissions
+        if "cache" in info:
+            cache_counts[info["cache"]] += 1
+        if connection and not np.isnan(emissions).any():
+            rows.append(result_row(index, vehicle_types, vehicle_counts[index - first_index],
+                                   emissions, **info))
+            if len(rows) >= commit_every:
+                write_results(connection, rows)
+                rows = []
+        if manifest_file and not np.isnan(emissions).any():
+            append_manifest(manifest_file, {
+                "index": index,
+                "hash": hashes[index - first_index],
+                "counts": [int(count) for count in vehicle_counts[index - first_index]],
+                "emissions": [float(value) for value in emissions],
+            })
+        if on_result and on_result(index, emissions):
+            print(f"Stopping sweep early after design point {index}")
+            break
+    sweep.close()
+
+    if connection:
+        write_results(connection, rows)
+        connection.close()
+    if settings.get("cache_dir"):
+        print(result_cache.cache_report(settings["cache_dir"], cache_counts["hit"],
+                                        cache_counts["miss"]))
+    return results